@@ -0,0 +1,61 @@
+import csv
+import enum
+import io
+from datetime import datetime
+from typing import Any, List
+
+from sqlmodel import Session, SQLModel
+
+
+COPY_NULL = r"\N"
+
+
+def _copy_value(value: Any) -> Any:
+    """Formats a value for PostgreSQL's CSV COPY input."""
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\x" + bytes(value).hex()  # bytea hex format
+    if isinstance(value, enum.Enum):
+        return value.name  # SQLAlchemy Enum columns store member names
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def copy_models(session: Session, objects: List[SQLModel]) -> int:
+    """
+    Inserts model objects of one table with PostgreSQL COPY FROM STDIN, in the
+    session's current transaction.
+
+    Rows are streamed as CSV through psycopg2's copy_expert; bytea columns such as
+    Plan.route are hex-encoded. Autoincrement primary keys are left to the database,
+    and the objects are not added to the session.
+
+    Args:
+        session: A session bound to a PostgreSQL engine using psycopg2.
+        objects: Model objects that all belong to the same table.
+
+    Returns:
+        The number of rows copied.
+    """
+    if not objects:
+        return 0
+    table = type(objects[0]).__table__
+    columns = [
+        column for column in table.columns
+        if not (column.primary_key and getattr(objects[0], column.name) is None)
+    ]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for obj in objects:
+        writer.writerow([_copy_value(getattr(obj, column.name)) for column in columns])
+    buffer.seek(0)
+
+    column_list = ", ".join(f'"{column.name}"' for column in columns)
+    statement = f'COPY "{table.name}" ({column_list}) FROM STDIN WITH (FORMAT csv, NULL \'{COPY_NULL}\')'
+    dbapi_connection = session.connection().connection.dbapi_connection
+    with dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(statement, buffer)
+    return len(objects)
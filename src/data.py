@@ -1,34 +1,318 @@
-from typing import List, Tuple, Dict, Any
+from datetime import timedelta
+from typing import List, Tuple, Dict, Any, NamedTuple, Optional, Set
+from sqlalchemy import func, update, values, column, bindparam, make_url, Integer, Float
 from sqlmodel import create_engine, Session, select, delete, SQLModel
-from lakebase_responders_entities import Emergency, Vehicle, Plan
+from lakebase_responders_entities import Emergency, Vehicle, Plan, UrgencyLevel
+from bulk import copy_models
+
+
+CHANGE_CHANNEL = "entity_changes"
+# Row triggers publish "<table>:<u|d>:<id>" on commit; TRUNCATE publishes "<table>:t:".
+CHANGE_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION notify_entity_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('{CHANGE_CHANNEL}', TG_TABLE_NAME || ':t:');
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{CHANGE_CHANNEL}', TG_TABLE_NAME || ':d:' || OLD.id);
+    ELSE
+        PERFORM pg_notify('{CHANGE_CHANNEL}', TG_TABLE_NAME || ':u:' || NEW.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+class EmergencySnapshot(NamedTuple):
+    """Read-only copy of the Emergency columns a tick uses."""
+    id: int
+    lon: float
+    lat: float
+    urgency: UrgencyLevel
+
+
+class VehicleSnapshot(NamedTuple):
+    """Read-only copy of the Vehicle columns a tick uses."""
+    id: int
+    lon: float
+    lat: float
+
+
+SNAPSHOT_TYPES = {Emergency: EmergencySnapshot, Vehicle: VehicleSnapshot}
+
 
 class DataManager:
-    """Handles all database operations for the emergency response simulation."""
+    """
+    Handles all database operations for the emergency response simulation.
+
+    Every read and every transaction uses its own short-lived session or connection
+    from the engine's pool, so no identity map outlives a tick. Emergencies and
+    vehicles are returned as immutable snapshots built from Core rows, not as
+    session-bound ORM objects.
+    """
 
-    def __init__(self, db_url: str):
+    def __init__(self, db_url: str, eta_tolerance_seconds: float = 30, copy_above: int = 500,
+                 incremental: bool = False, pool_size: int = 3, max_overflow: int = 2,
+                 pool_recycle_seconds: int = 1800):
         """
         Initializes the DataManager with a database connection URL.
 
         Args:
             db_url: The connection string for the database.
+            eta_tolerance_seconds: A stored plan keeps its ETA unless the new one
+                differs by more than this, so stable plans are not rewritten every tick.
+            copy_above: On PostgreSQL, new plans are bulk-loaded with COPY instead of
+                INSERTs when there are more than this many.
+            incremental: On PostgreSQL, keep an in-memory snapshot of emergencies and
+                vehicles and only re-read the rows that LISTEN/NOTIFY triggers report
+                as changed, instead of reading both tables on every tick.
+            pool_size: Connections kept open in the pool. The LISTEN connection of
+                incremental mode holds one of them for the DataManager's lifetime.
+            max_overflow: Extra connections opened when the pool is exhausted.
+            pool_recycle_seconds: Connections older than this are replaced, and every
+                connection is pinged before use, so idle-dropped connections recover.
         """
-        self.engine = create_engine(db_url)
+        self.eta_tolerance = timedelta(seconds=eta_tolerance_seconds)
+        self.copy_above = copy_above
+        pool_options = {}
+        if make_url(db_url).get_backend_name() != "sqlite":
+            pool_options = dict(
+                pool_size=pool_size, max_overflow=max_overflow,
+                pool_recycle=pool_recycle_seconds, pool_pre_ping=True
+            )
+        self.engine = create_engine(db_url, **pool_options)
         SQLModel.metadata.create_all(self.engine)
-        self.session = Session(self.engine)
+        self._listener = None
+        self._snapshot: Optional[Dict[type, Dict[int, NamedTuple]]] = None
+        self._incremental = incremental and self.engine.dialect.name == "postgresql"
+        if self._incremental:
+            self._install_change_triggers()
+            self._listen()
+        elif incremental:
+            print("Incremental fetch needs PostgreSQL; reading full tables every tick.")
 
-    def get_entities(self) -> Tuple[List[Emergency], List[Vehicle]]:
+    def _install_change_triggers(self):
+        """Installs the triggers that notify about changed emergencies and vehicles."""
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(CHANGE_TRIGGER_SQL)
+            for table in (Emergency.__tablename__, Vehicle.__tablename__):
+                connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS notify_change ON "{table}"')
+                connection.exec_driver_sql(
+                    f'CREATE TRIGGER notify_change AFTER INSERT OR UPDATE OR DELETE ON "{table}" '
+                    f'FOR EACH ROW EXECUTE FUNCTION notify_entity_change()'
+                )
+                connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS notify_truncate ON "{table}"')
+                connection.exec_driver_sql(
+                    f'CREATE TRIGGER notify_truncate AFTER TRUNCATE ON "{table}" '
+                    f'FOR EACH STATEMENT EXECUTE FUNCTION notify_entity_change()'
+                )
+
+    def _listen(self):
+        """Opens a dedicated connection that listens for the change notifications."""
+        self._listener = self.engine.raw_connection()
+        self._listener.dbapi_connection.autocommit = True
+        with self._listener.dbapi_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANGE_CHANNEL}")
+
+    def _close_listener(self):
+        """Closes the LISTEN connection and keeps it out of the pool."""
+        try:
+            self._listener.invalidate()
+        except Exception as e:
+            print(f"WARNING: Closing the change listener failed: {e}")
+        self._listener = None
+
+    def _drain_changes(self) -> Optional[Dict[type, Tuple[Set[int], Set[int]]]]:
+        """
+        Collects the notifications received since the last call.
+
+        The LISTEN connection is held outside the pool's pre-ping and recycling, so if
+        it has been dropped it is replaced here. Notifications sent while it was down
+        are lost, which is reported as a full reload.
+
+        Returns:
+            For each model, the IDs of rows inserted or updated and the IDs of rows
+            deleted; or None if the snapshot must be read in full, because a table
+            was truncated or the listener was (re)connected.
+        """
+        if self._listener is None:
+            self._listen()
+            return None
+        connection = self._listener.dbapi_connection
+        dbapi = self.engine.dialect.loaded_dbapi
+        try:
+            connection.poll()
+        except (dbapi.OperationalError, dbapi.InterfaceError) as e:
+            print(f"WARNING: Lost the change listener ({e}). Reconnecting and reloading all entities.")
+            self._close_listener()
+            self._listen()
+            return None
+        models = {Emergency.__tablename__: Emergency, Vehicle.__tablename__: Vehicle}
+        changes = {model: (set(), set()) for model in models.values()}
+        truncated = False
+        while connection.notifies:
+            table, operation, row_id = connection.notifies.pop(0).payload.split(":")
+            if table not in models:
+                continue
+            upserted, deleted = changes[models[table]]
+            if operation == "t":
+                truncated = True
+            elif operation == "d":
+                upserted.discard(int(row_id))
+                deleted.add(int(row_id))
+            else:
+                deleted.discard(int(row_id))
+                upserted.add(int(row_id))
+        return None if truncated else changes
+
+    def _read_rows(self, model, ids: Optional[Set[int]] = None) -> Dict[int, NamedTuple]:
+        """Reads the snapshot columns of rows by ID, or of the whole table, as Core rows."""
+        snapshot_type = SNAPSHOT_TYPES[model]
+        statement = select(*(getattr(model, field) for field in snapshot_type._fields))
+        if ids is not None:
+            statement = statement.where(model.id.in_(ids))
+        with self.engine.connect() as connection:
+            return {row.id: snapshot_type._make(row) for row in connection.execute(statement)}
+
+    def _get_entities_incremental(self) -> Tuple[List[EmergencySnapshot], List[VehicleSnapshot]]:
+        """Merges the rows changed since the last tick into the in-memory snapshot."""
+        # Drain before reading, so a change made during the read is picked up next tick
+        changes = self._drain_changes()
+        if self._snapshot is None or changes is None:
+            self._snapshot = {model: self._read_rows(model) for model in (Emergency, Vehicle)}
+            print("Loaded a full snapshot of emergencies and vehicles.")
+        else:
+            for model, (upserted, deleted) in changes.items():
+                rows = self._snapshot[model]
+                for row_id in deleted:
+                    rows.pop(row_id, None)
+                if upserted:
+                    rows.update(self._read_rows(model, upserted))
+            print("Applied changes: " + "; ".join(
+                f"{model.__tablename__} {len(upserted)} changed, {len(deleted)} removed"
+                for model, (upserted, deleted) in changes.items()
+            ))
+        return list(self._snapshot[Emergency].values()), list(self._snapshot[Vehicle].values())
+
+    def get_entities(self) -> Tuple[List[EmergencySnapshot], List[VehicleSnapshot]]:
         """
         Fetches all current emergencies and vehicles from the database.
 
         Returns:
-            A tuple containing a list of Emergency objects and a list of Vehicle objects.
+            A tuple containing a list of EmergencySnapshot and a list of VehicleSnapshot
+            objects.
         """
         print("Fetching emergencies and vehicles from the database...")
-        emergencies = self.session.exec(select(Emergency)).all()
-        vehicles = self.session.exec(select(Vehicle)).all()
+        if self._incremental:
+            emergencies, vehicles = self._get_entities_incremental()
+        else:
+            emergencies = list(self._read_rows(Emergency).values())
+            vehicles = list(self._read_rows(Vehicle).values())
         print(f"Found {len(emergencies)} emergencies and {len(vehicles)} vehicles.")
         return emergencies, vehicles
 
+    def get_next_legs(self) -> List[Plan]:
+        """
+        Fetches the first plan of every vehicle, i.e. the leg it is currently driving.
+
+        Returns:
+            A list of Plan objects, at most one per vehicle.
+        """
+        first_index = (
+            select(Plan.vehicle_id, func.min(Plan.plan_index).label("plan_index"))
+            .group_by(Plan.vehicle_id)
+            .subquery()
+        )
+        statement = select(Plan).join(
+            first_index,
+            (Plan.vehicle_id == first_index.c.vehicle_id) & (Plan.plan_index == first_index.c.plan_index)
+        )
+        with Session(self.engine) as session:
+            return session.exec(statement).all()
+
+    def update_vehicle_positions(self, vehicle_updates: List[Dict[str, Any]]):
+        """
+        Writes new vehicle locations in their own transaction.
+
+        Args:
+            vehicle_updates: A list of dictionaries with vehicle ID, new lon, and new lat.
+        """
+        with Session(self.engine) as session:
+            try:
+                self._stage_vehicle_updates(session, vehicle_updates)
+                session.commit()
+            except Exception as e:
+                print(f"ERROR: Updating vehicle positions failed. Rolling back. Details: {e}")
+                session.rollback()
+                raise
+
+    def _stage_vehicle_updates(self, session: Session, vehicle_updates: List[Dict[str, Any]]):
+        """
+        Stages all vehicle location updates as one set-based statement.
+
+        On PostgreSQL this is a single UPDATE ... FROM (VALUES ...); other databases get
+        one executemany of a parameterized UPDATE. Either way no vehicle is loaded first.
+        """
+        if not vehicle_updates:
+            return
+        vehicles = Vehicle.__table__
+        if self.engine.dialect.name == "postgresql":
+            new_positions = values(
+                column("id", Integer), column("lon", Float), column("lat", Float), name="new_positions"
+            ).data([(update["id"], update["lon"], update["lat"]) for update in vehicle_updates])
+            session.execute(
+                update(vehicles)
+                .where(vehicles.c.id == new_positions.c.id)
+                .values(lon=new_positions.c.lon, lat=new_positions.c.lat)
+            )
+        else:
+            session.execute(
+                update(vehicles)
+                .where(vehicles.c.id == bindparam("vehicle_id"))
+                .values(lon=bindparam("new_lon"), lat=bindparam("new_lat")),
+                [{"vehicle_id": u["id"], "new_lon": u["lon"], "new_lat": u["lat"]} for u in vehicle_updates]
+            )
+
+    def _stage_plan_diff(self, session: Session, plans_to_save: List[Plan]) -> Tuple[int, int, int]:
+        """
+        Stages the difference between the stored plans and the new ones, matched by
+        (vehicle_id, plan_index, emergency_id): matching rows are updated only when their
+        route or ETA changed, new rows are inserted and rows that disappeared are deleted.
+
+        Returns:
+            The numbers of inserted, updated and deleted plans.
+        """
+        stored = {
+            (plan.vehicle_id, plan.plan_index, plan.emergency_id): plan
+            for plan in session.exec(select(Plan)).all()
+        }
+        new_plans, updated = [], 0
+        for plan in plans_to_save:
+            current = stored.pop((plan.vehicle_id, plan.plan_index, plan.emergency_id), None)
+            if current is None:
+                new_plans.append(plan)
+                continue
+            changed = False
+            if abs(current.eta - plan.eta) > self.eta_tolerance:
+                current.eta = plan.eta
+                changed = True
+            if current.route != plan.route:
+                current.route = plan.route
+                changed = True
+            updated += changed
+
+        # Delete before inserting, so a replaced (vehicle_id, plan_index) slot is free
+        if stored:
+            session.exec(delete(Plan).where(Plan.id.in_([plan.id for plan in stored.values()])))
+        if self.engine.dialect.name == "postgresql" and len(new_plans) > self.copy_above:
+            session.flush()
+            copy_models(session, new_plans)
+        else:
+            session.add_all(new_plans)
+        session.flush()
+        return len(new_plans), updated, len(stored)
+
     def update_state_in_transaction(
         self,
         plans_to_save: List[Plan],
@@ -44,43 +328,39 @@ class DataManager:
             vehicle_updates: A list of dictionaries with vehicle ID, new lon, and new lat.
         """
         print("\nUpdating simulation state within a single database transaction...")
-        try:
-            # Stage 1: Delete all old plans.
-            self.session.exec(delete(Plan))
-            print("  - Staged: Deletion of old plans.")
-
-            # Stage 2: Add all new plans to the session.
-            self.session.add_all(plans_to_save)
-            print(f"  - Staged: {len(plans_to_save)} new plans to be saved.")
-
-            # Stage 3: Delete completed emergencies.
-            if completed_emergency_ids:
-                statement = delete(Emergency).where(Emergency.id.in_(completed_emergency_ids))
-                self.session.exec(statement)
-                print(f"  - Staged: {len(completed_emergency_ids)} emergencies to be removed.")
-            
-            # **CRITICAL FIX**: Explicitly update vehicle locations within the transaction.
-            if vehicle_updates:
-                print(f"  - Staging updates for {len(vehicle_updates)} vehicles...")
-                for update in vehicle_updates:
-                    # Fetch the vehicle by its ID within the current session
-                    vehicle_to_update = self.session.get(Vehicle, update["id"])
-                    if vehicle_to_update:
-                        vehicle_to_update.lon = update["lon"]
-                        vehicle_to_update.lat = update["lat"]
-
-            # Commit Stage: All staged changes are written to the DB at once.
-            self.session.commit()
-            print("Transaction successful. All changes have been committed.")
+        with Session(self.engine) as session:
+            try:
+                # Stage 1: Write only the plans that changed. Plans of completed emergencies
+                # disappear here, before the emergencies themselves are deleted.
+                inserted, updated, deleted = self._stage_plan_diff(session, plans_to_save)
+                print(f"  - Staged: {inserted} plans inserted, {updated} updated, {deleted} deleted, "
+                      f"{len(plans_to_save) - inserted - updated} unchanged.")
 
-        except Exception as e:
-            print(f"ERROR: Database transaction failed. Rolling back all changes. Details: {e}")
-            self.session.rollback()
-            raise
+                # Stage 2: Delete completed emergencies.
+                if completed_emergency_ids:
+                    statement = delete(Emergency).where(Emergency.id.in_(completed_emergency_ids))
+                    session.exec(statement)
+                    print(f"  - Staged: {len(completed_emergency_ids)} emergencies to be removed.")
+
+                # **CRITICAL FIX**: Explicitly update vehicle locations within the transaction.
+                if vehicle_updates:
+                    print(f"  - Staging updates for {len(vehicle_updates)} vehicles...")
+                    self._stage_vehicle_updates(session, vehicle_updates)
+
+                # Commit Stage: All staged changes are written to the DB at once.
+                session.commit()
+                print("Transaction successful. All changes have been committed.")
+
+            except Exception as e:
+                print(f"ERROR: Database transaction failed. Rolling back all changes. Details: {e}")
+                session.rollback()
+                raise
 
     def close(self):
-        """Closes the database session and disposes of the engine."""
+        """Closes the change listener and disposes of the engine's connection pool."""
         print("Closing database connection.")
-        self.session.close()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
         self.engine.dispose()
 
@@ -0,0 +1,317 @@
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Any, List, Tuple, Optional
+
+import numpy as np
+
+from matrix import TravelMatrix
+from optimizer import RouteOptimizer, RouteMemory, route_etas
+
+
+_incumbents = None  # A worker's queue for (cluster, routes, objective), set by _set_incumbent_queue
+
+
+def _set_incumbent_queue(queue):
+    """Worker initializer that hands every worker the queue incumbents are published to."""
+    global _incumbents
+    _incumbents = queue
+
+
+def _solve_cluster(cluster: int, matrix: TravelMatrix, goal: str, time_limit_seconds: int,
+                   warm_time_limit_seconds: Optional[int], stall_seconds: Optional[float], native_transits: bool,
+                   route_memory: Optional[RouteMemory], max_stops: Optional[int]):
+    """
+    Solves one cluster's sub-VRP. Runs in a worker process. The remembered routes
+    are mapped onto the cluster's own entities, so only its share of them is used.
+    """
+    optimizer = RouteOptimizer(matrix, matrix.num_vehicles, goal, native_transits=native_transits,
+                               route_memory=route_memory, max_stops=max_stops)
+    on_improvement = None
+    if _incumbents is not None:
+        on_improvement = lambda routes, objective: _incumbents.put((cluster, routes, objective))
+    return optimizer.solve(time_limit_seconds, warm_time_limit_seconds=warm_time_limit_seconds,
+                           stall_seconds=stall_seconds, on_improvement=on_improvement)
+
+
+class DecomposedOptimizer:
+    """
+    Solves a large VRP by clustering emergencies and vehicles geographically, solving
+    each cluster as an independent RouteOptimizer problem in a process pool, and then
+    merging the routes and repairing them across cluster boundaries.
+    """
+
+    KMEANS_ITERATIONS = 25
+    REPAIR_PASSES = 2
+    REPAIR_NEIGHBOURS = 3  # Nearest foreign vehicles considered for each boundary emergency
+
+    def __init__(self, matrix: TravelMatrix, num_vehicles, goal, cluster_size=50, max_workers=None,
+                 native_transits=True, route_memory: Optional[RouteMemory] = None, max_stops=None):
+        """
+        Args:
+            matrix: The TravelMatrix from RoutingService, indexed like emergencies + vehicles.
+            num_vehicles: The number of vehicles to use.
+            goal: The optimization objective, e.g., "time" or "distance".
+            cluster_size: Target number of emergencies per cluster.
+            max_workers: Maximum number of worker processes; defaults to the number of CPUs.
+            native_transits: Passed through to each cluster's RouteOptimizer.
+            route_memory: If given, every cluster starts from its part of the remembered
+                routes and the merged, repaired solution is stored back into it.
+            max_stops: Passed through to each cluster's RouteOptimizer.
+        """
+        self.matrix = matrix
+        self.num_vehicles = num_vehicles
+        self.goal = goal
+        self.cluster_size = cluster_size
+        self.max_workers = max_workers
+        self.native_transits = native_transits
+        self.route_memory = route_memory
+        self.max_stops = max_stops
+        self.num_emergencies = matrix.num_emergencies
+        if goal == "time":
+            self.costs = matrix.time.astype(np.int64)
+        else:
+            self.costs = (matrix.distance.astype(np.float64) * 100).astype(np.int64)
+
+    def _planar_points(self) -> np.ndarray:
+        """Lat/lon scaled so that Euclidean distance approximates ground distance locally."""
+        scale = math.cos(math.radians(float(self.matrix.lats.mean())))
+        return np.column_stack((self.matrix.lats, self.matrix.lons * scale))
+
+    def _kmeans(self, points: np.ndarray, k: int) -> np.ndarray:
+        """Plain Lloyd's k-means with farthest-point seeding; returns the centroids."""
+        centroids = [points[0]]
+        distances = np.linalg.norm(points - points[0], axis=1)
+        for _ in range(1, k):
+            centroids.append(points[int(distances.argmax())])
+            distances = np.minimum(distances, np.linalg.norm(points - centroids[-1], axis=1))
+        centroids = np.array(centroids)
+        for _ in range(self.KMEANS_ITERATIONS):
+            labels = np.linalg.norm(points[:, None, :] - centroids[None, :, :], axis=2).argmin(axis=1)
+            updated = np.array([
+                points[labels == c].mean(axis=0) if (labels == c).any() else centroids[c] for c in range(k)
+            ])
+            if np.allclose(updated, centroids):
+                break
+            centroids = updated
+        return centroids
+
+    def _clusters(self) -> List[Tuple[List[int], List[int]]]:
+        """
+        Groups emergencies by k-means and gives each cluster at least one vehicle.
+
+        Returns:
+            A list of (emergency nodes, vehicle nodes) per non-empty cluster.
+        """
+        points = self._planar_points()
+        emergency_points = points[:self.num_emergencies]
+        vehicle_points = points[self.num_emergencies:]
+        k = max(1, min(math.ceil(self.num_emergencies / self.cluster_size), self.num_vehicles))
+        centroids = self._kmeans(emergency_points, k)
+
+        emergency_labels = np.linalg.norm(emergency_points[:, None] - centroids[None], axis=2).argmin(axis=1)
+        occupied = [c for c in range(k) if (emergency_labels == c).any()]
+        centroids = centroids[occupied]
+        emergency_labels = np.searchsorted(occupied, emergency_labels)
+
+        # Every cluster first takes its closest free vehicle, busiest clusters first;
+        # remaining vehicles then join whichever cluster centroid is nearest.
+        vehicle_distances = np.linalg.norm(vehicle_points[:, None] - centroids[None], axis=2)
+        vehicle_labels = np.full(self.num_vehicles, -1)
+        for c in np.argsort(-np.bincount(emergency_labels, minlength=len(centroids))):
+            free = np.flatnonzero(vehicle_labels < 0)
+            vehicle_labels[free[vehicle_distances[free, c].argmin()]] = c
+        unassigned = vehicle_labels < 0
+        vehicle_labels[unassigned] = vehicle_distances[unassigned].argmin(axis=1)
+
+        return [
+            (np.flatnonzero(emergency_labels == c).tolist(),
+             (np.flatnonzero(vehicle_labels == c) + self.num_emergencies).tolist())
+            for c in range(len(centroids))
+        ]
+
+    def _route_cost(self, vehicle_node: int, route: List[int]) -> int:
+        """Arc cost plus the urgency position penalties RouteOptimizer applies."""
+        cost, position, previous = 0, 0, vehicle_node
+        for node in route:
+            cost += int(self.costs[previous, node])
+            urgency = self.matrix.urgency[node]
+            position += RouteOptimizer.URGENCY_POSITION_WEIGHTS.get(urgency, 3)
+            if urgency in RouteOptimizer.URGENCY_SOFT_BOUNDS:
+                bound, penalty = RouteOptimizer.URGENCY_SOFT_BOUNDS[urgency]
+                cost += max(0, position - bound) * penalty
+            previous = node
+        return cost
+
+    def _within_capacity(self, vehicle_node: int, route: List[int]) -> bool:
+        """
+        Whether a route fits the Position and Time/Distance capacities of RouteOptimizer's
+        model. With max_stops only the horizon is checked: stops past it are the greedy
+        tail RouteOptimizer appends outside the model, so a move may lengthen the tail.
+        """
+        if self.max_stops is not None:
+            route = route[:self.max_stops]
+        # The virtual end depot takes one more position
+        positions = sum(RouteOptimizer.URGENCY_POSITION_WEIGHTS.get(self.matrix.urgency[n], 3) for n in route) + 1
+        if positions > RouteOptimizer.POSITION_CAPACITY:
+            return False
+        path = [vehicle_node] + route
+        return int(self.costs[path[:-1], path[1:]].sum()) <= RouteOptimizer.ROUTE_CAPACITY
+
+    def _repair(self, routes: Dict[int, List[int]], cluster_of: Dict[int, int]) -> int:
+        """
+        Relocates emergencies to routes of nearby vehicles in other clusters whenever
+        that lowers the combined cost of both routes. A move is skipped if it would
+        push the receiving route, or a donor route that was within them, over the
+        capacities each cluster's model enforced.
+
+        Args:
+            routes: Vehicle node -> emergency nodes, modified in place.
+            cluster_of: Vehicle node -> cluster number.
+
+        Returns:
+            The number of emergencies moved.
+        """
+        vehicle_nodes = np.array(sorted(routes))
+        moves = 0
+        for _ in range(self.REPAIR_PASSES):
+            moved_this_pass = 0
+            for vehicle, route in list(routes.items()):
+                for node in list(route):
+                    if node not in route:
+                        continue
+                    nearest = vehicle_nodes[np.argsort(self.costs[vehicle_nodes, node])]
+                    foreign = [v for v in nearest if cluster_of[v] != cluster_of[vehicle]][:self.REPAIR_NEIGHBOURS]
+                    if not foreign:
+                        continue
+                    reduced = [n for n in route if n != node]
+                    if not self._within_capacity(vehicle, reduced) and self._within_capacity(vehicle, route):
+                        continue
+                    removal_gain = self._route_cost(vehicle, route) - self._route_cost(vehicle, reduced)
+                    best: Optional[Tuple[int, int, int]] = None
+                    for other in foreign:
+                        other = int(other)
+                        base = self._route_cost(other, routes[other])
+                        for pos in range(len(routes[other]) + 1):
+                            candidate = routes[other][:pos] + [node] + routes[other][pos:]
+                            if not self._within_capacity(other, candidate):
+                                continue
+                            delta = self._route_cost(other, candidate) - base
+                            if delta < removal_gain and (best is None or delta < best[0]):
+                                best = (delta, other, pos)
+                    if best:
+                        _, other, pos = best
+                        routes[vehicle] = route = reduced
+                        routes[other].insert(pos, node)
+                        moved_this_pass += 1
+            moves += moved_this_pass
+            if not moved_this_pass:
+                break
+        return moves
+
+    @staticmethod
+    def _merge_cluster(routes: Dict[int, List[int]], cluster_nodes: List[int], result: List[Dict[str, Any]]):
+        """Adds a cluster's routes to `routes`, translating its local nodes into global ones."""
+        for route in result:
+            stops = [cluster_nodes[node] for node in route["stops"]]
+            routes[stops[0]] = stops[1:]
+
+    def _format(self, routes: Dict[int, List[int]]) -> List[Dict[str, Any]]:
+        """Formats vehicle node -> emergency nodes like RouteOptimizer.solve() does."""
+        vehicle_routes = []
+        for vehicle_node in range(self.num_emergencies, self.num_emergencies + self.num_vehicles):
+            stops = [vehicle_node] + routes.get(vehicle_node, [])
+            vehicle_routes.append({
+                "vehicle_id": vehicle_node - self.num_emergencies,
+                "stops": stops,
+                "etas": route_etas(self.matrix.time, stops)
+            })
+        return vehicle_routes
+
+    def _relay(self, queue, clusters: List[Tuple[List[int], List[int]]],
+               on_improvement: Callable[[List[Dict[str, Any]], int], None]):
+        """
+        Combines the latest incumbent of every cluster into one unrepaired plan and
+        passes it on each time a cluster improves, once every cluster has one.
+        """
+        latest: Dict[int, Tuple[List[Dict[str, Any]], int]] = {}
+        for cluster, result, objective in iter(queue.get, None):
+            latest[cluster] = (result, objective)
+            if len(latest) < len(clusters):
+                continue
+            routes: Dict[int, List[int]] = {}
+            for c, (cluster_result, _) in latest.items():
+                emergencies, vehicles = clusters[c]
+                self._merge_cluster(routes, emergencies + vehicles, cluster_result)
+            on_improvement(self._format(routes), sum(objective for _, objective in latest.values()))
+
+    def solve(self, time_limit_seconds=10, warm_time_limit_seconds=None, stall_seconds=None, on_improvement=None):
+        """
+        Solve the decomposed Vehicle Routing Problem.
+
+        Args:
+            time_limit_seconds: Wall-clock budget for all clusters together.
+            warm_time_limit_seconds: A shorter budget for all clusters together, used
+                by clusters that can be warm-started from the route memory.
+            stall_seconds: Lets each cluster stop early once its objective stalls.
+            on_improvement: Called as on_improvement(routes, objective) whenever a
+                cluster improves once every cluster has a solution, with the merged
+                routes before boundary repair and the sum of the cluster objectives.
+                It runs on a background thread of this process.
+
+        Returns:
+            A list of vehicle route dictionaries in RouteOptimizer.solve() format,
+            or an error dictionary.
+        """
+        clusters = self._clusters()
+        workers = min(self.max_workers or os.cpu_count(), len(clusters))
+        rounds = math.ceil(len(clusters) / workers)
+        cluster_time_limit = max(1, time_limit_seconds // rounds)
+        cluster_warm_time_limit = None
+        if warm_time_limit_seconds is not None:
+            cluster_warm_time_limit = max(1, warm_time_limit_seconds // rounds)
+        print(f"Solving {len(clusters)} VRP clusters on {workers} processes "
+              f"({cluster_time_limit}s each)...")
+
+        # Forking a parent that runs relay and driver threads can copy a held lock into the
+        # workers, so they are started from a clean forkserver process instead
+        context = multiprocessing.get_context("forkserver")
+        # A SimpleQueue put is synchronous, so every incumbent is queued before its worker returns
+        queue = context.SimpleQueue() if on_improvement else None
+        relay = None
+        if queue is not None:
+            relay = threading.Thread(target=self._relay, args=(queue, clusters, on_improvement), daemon=True)
+            relay.start()
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_set_incumbent_queue,
+                                     initargs=(queue,), mp_context=context) as pool:
+                futures = [
+                    pool.submit(_solve_cluster, c, self.matrix.subset(emergencies + vehicles), self.goal,
+                                cluster_time_limit, cluster_warm_time_limit, stall_seconds, self.native_transits,
+                                self.route_memory, self.max_stops)
+                    for c, (emergencies, vehicles) in enumerate(clusters)
+                ]
+                results = [future.result() for future in futures]
+        finally:
+            if relay is not None:
+                queue.put(None)
+                relay.join()
+
+        routes: Dict[int, List[int]] = {}
+        cluster_of: Dict[int, int] = {}
+        for c, ((emergencies, vehicles), result) in enumerate(zip(clusters, results)):
+            if "error" in result:
+                error_msg = f"Cluster {c} failed: {result['error']}"
+                print(error_msg)
+                return {"error": error_msg}
+            self._merge_cluster(routes, emergencies + vehicles, result)
+            cluster_of.update((vehicle, c) for vehicle in vehicles)
+
+        moved = self._repair(routes, cluster_of)
+        print(f"Boundary repair moved {moved} emergencies between clusters.")
+        vehicle_routes = self._format(routes)
+        if self.route_memory is not None:
+            self.route_memory.remember(self.matrix, vehicle_routes)
+        return vehicle_routes
@@ -0,0 +1,171 @@
+from functools import lru_cache
+from typing import List, Tuple
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+
+POLYLINE_PRECISION = 1e6  # Valhalla's polyline6 encoding
+WGS84_EPSG = 4326
+
+
+@lru_cache(maxsize=None)
+def transformer(source_epsg: int, target_epsg: int) -> Transformer:
+    """Returns a cached lon/lat-ordered (always_xy) transformer between two CRSs."""
+    return Transformer.from_crs(source_epsg, target_epsg, always_xy=True)
+
+
+def reproject(geometries: np.ndarray, source_epsg: int, target_epsg: int) -> np.ndarray:
+    """Reprojects an array of geometries, passing all their coordinates to one transform call."""
+    project = transformer(source_epsg, target_epsg)
+    return shapely.transform(
+        geometries, lambda coords: np.column_stack(project.transform(coords[:, 0], coords[:, 1]))
+    )
+
+
+def utm_epsg(lons: np.ndarray, lats: np.ndarray) -> int:
+    """EPSG code of the WGS84 UTM zone that contains the centre of the given coordinates."""
+    lon, lat = float(np.mean(lons)), float(np.mean(lats))
+    zone = int((lon + 180) // 6) % 60 + 1
+    return (32600 if lat >= 0 else 32700) + zone
+
+
+def decode_polyline(encoded: str, precision: float = POLYLINE_PRECISION) -> np.ndarray:
+    """
+    Decodes an encoded polyline into an (n, 2) array of lon/lat coordinates.
+
+    Every byte is decoded at once with NumPy: bytes are split into varint chunks at
+    the continuation bit, zigzag-decoded, and the lat/lon deltas summed up.
+    """
+    chunks = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if not len(chunks):
+        return np.empty((0, 2))
+    last_of_value = (chunks & 0x20) == 0
+    starts = np.flatnonzero(np.r_[True, last_of_value[:-1]])
+    shift = 5 * (np.arange(len(chunks)) - np.repeat(starts, np.diff(np.r_[starts, len(chunks)])))
+    values = np.add.reduceat((chunks & 0x1f) << shift, starts)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1).reshape(-1, 2)
+    return np.cumsum(deltas, axis=0)[:, ::-1] / precision
+
+
+def polylines_to_lines(encoded: List[str], precision: float = POLYLINE_PRECISION) -> np.ndarray:
+    """Decodes encoded polylines into an array of WGS84 LineStrings."""
+    coords = [decode_polyline(e, precision) for e in encoded]
+    # A LineString needs two coordinates, which a stationary leg may not have
+    coords = [np.repeat(c, 2, axis=0) if len(c) == 1 else c for c in coords]
+    if not coords:
+        return np.empty(0, dtype=object)
+    indices = np.repeat(np.arange(len(coords)), [len(c) for c in coords])
+    return shapely.linestrings(np.concatenate(coords), indices=indices)
+
+
+def advance_along(lines: np.ndarray, distance: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Moves a vehicle `distance` along each of its routes.
+
+    All routes are handled together with shapely's vectorized functions; routes
+    shorter than `distance` end at their last coordinate.
+
+    Args:
+        lines: Array of LineStrings in a metric CRS, one per vehicle.
+        distance: Distance to travel along every line, in the units of the CRS.
+
+    Returns:
+        A tuple of (positions, remaining): the Points reached, and the LineStrings
+        still ahead of them, which start at the reached point.
+    """
+    lines = np.asarray(lines, dtype=object)
+    positions = shapely.line_interpolate_point(lines, distance)
+    return positions, remaining_lines(lines, positions, distance)
+
+
+def remaining_lines(lines: np.ndarray, positions: np.ndarray, distance: float) -> np.ndarray:
+    """
+    Cuts off the first `distance` of every line, starting it at the given position.
+
+    Args:
+        lines: Array of LineStrings in a metric CRS.
+        positions: The points `distance` along each line, as from line_interpolate_point.
+        distance: The distance that was travelled along each line.
+
+    Returns:
+        An array with the remainder of every line. A line that has been travelled to
+        its end becomes a degenerate line on its last coordinate.
+    """
+    return _cut_lines(lines, positions, distance, keep_ahead=True)
+
+
+def travelled_lines(lines: np.ndarray, positions: np.ndarray, distance: float) -> np.ndarray:
+    """
+    Keeps only the first `distance` of every line, ending it at the given position.
+    Takes the same arguments as remaining_lines().
+    """
+    return _cut_lines(lines, positions, distance, keep_ahead=False)
+
+
+def _cut_lines(lines: np.ndarray, positions: np.ndarray, distance: float, keep_ahead: bool) -> np.ndarray:
+    """Splits every line at its position and keeps the part ahead of or behind it."""
+    coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+    if not len(coords):
+        return lines.copy()
+
+    # Distance along its own line of every coordinate
+    step = np.linalg.norm(np.diff(coords, axis=0), axis=1)
+    step[np.diff(line_idx) != 0] = 0.0
+    travelled = np.concatenate(([0.0], np.cumsum(step)))
+    first_of_line = np.flatnonzero(np.r_[True, np.diff(line_idx) != 0])
+    travelled -= np.repeat(travelled[first_of_line], np.diff(np.r_[first_of_line, len(coords)]))
+
+    keep = travelled > distance if keep_ahead else travelled < distance
+    cut_points = shapely.get_coordinates(positions)
+    cut_idx = line_idx[first_of_line]
+    # The cut point starts the part ahead and ends the part behind; a stable sort on
+    # the line index interleaves it with the kept coordinates in order.
+    if keep_ahead:
+        all_coords = np.concatenate((cut_points, coords[keep]))
+        all_idx = np.concatenate((cut_idx, line_idx[keep]))
+    else:
+        all_coords = np.concatenate((coords[keep], cut_points))
+        all_idx = np.concatenate((line_idx[keep], cut_idx))
+    order = np.argsort(all_idx, kind="stable")
+    all_coords, all_idx = all_coords[order], all_idx[order]
+
+    # A LineString needs two coordinates; repeat the cut point of lines with nothing else
+    counts = np.bincount(all_idx, minlength=len(lines))
+    single = np.flatnonzero(counts == 1)
+    if len(single):
+        all_coords = np.concatenate((all_coords, cut_points[np.searchsorted(cut_idx, single)]))
+        all_idx = np.concatenate((all_idx, single))
+        order = np.argsort(all_idx, kind="stable")
+        all_coords, all_idx = all_coords[order], all_idx[order]
+
+    cut = lines.copy()
+    present = np.unique(all_idx)
+    _, compact_idx = np.unique(all_idx, return_inverse=True)
+    cut[present] = shapely.linestrings(all_coords, indices=compact_idx)
+    return cut
+
+
+def points_near(geometries: np.ndarray, points: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Finds every point within `threshold` of any of the geometries.
+
+    An STRtree is built over the points and queried with all geometries in one
+    vectorized call, so no pairwise distances are computed in Python.
+
+    Returns:
+        The sorted, unique indices of the points that were reached.
+    """
+    if not len(points) or not len(geometries):
+        return np.empty(0, dtype=np.intp)
+    _, point_idx = shapely.STRtree(points).query(geometries, predicate="dwithin", distance=threshold)
+    return np.unique(point_idx)
+
+
+def within_distance(points: np.ndarray, targets: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Element-wise check whether each point lies within `threshold` of its target.
+    Empty or missing points are never within distance.
+    """
+    return np.asarray(shapely.dwithin(points, targets, threshold), dtype=bool) & ~shapely.is_empty(points)
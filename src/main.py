@@ -1,5 +1,5 @@
 # Databricks notebook source
-# MAGIC %pip install --upgrade protobuf ortools sqlmodel==0.0.25 geopandas==1.1.1 numpy>=2
+# MAGIC %pip install --upgrade protobuf ortools sqlmodel==0.0.25 geopandas==1.1.1 numpy>=2 scipy
 # MAGIC %restart_python
 
 # COMMAND ----------
@@ -31,71 +31,164 @@ whl_path = str(max(Path(f"{volume_path}/whl").glob("*.whl"), key=lambda f: f.sta
 
 # COMMAND ----------
 
+import os
 import time
 from data import DataManager
 from routing import RoutingService
-from optimizer import RouteOptimizer
+from candidates import CandidateSelector
+from optimizer import RouteOptimizer, RouteMemory, Incumbent
+from decomposition import DecomposedOptimizer
+from portfolio import PortfolioOptimizer
+from dispatch import AssignmentDispatcher
 from plan_processor import PlanProcessor
+from motion import MotionEngine
 
 # COMMAND ----------
 
 # --- Configuration ---
 TICK_INTERVAL_SECONDS = 0  # How often to re-plan
 DISTANCE_PER_TICK_M = 200
+MOTION_INTERVAL_S = None  # Move vehicles by elapsed time this often, independently of replanning; None moves them DISTANCE_PER_TICK_M per tick
+MOTION_TIME_SCALE = 1.0  # Simulated seconds per wall-clock second for the motion engine
+PASS_THROUGH_RADIUS_M = 50  # Vehicles driving this close to any emergency complete it
+UTM_EPSG = None  # Metric CRS for moving vehicles, e.g. 25833 for Berlin; None picks the UTM zone from the data
 OPTIMIZATION_GOAL = "time"  # or "distance"
+DISPATCH_MODE = "vrp"  # or "assignment" for millisecond first-stop dispatch without the VRP
 VRP_TIMEOUT_S = 10
+VRP_STALL_S = 1  # Stop the solver early once the objective hasn't improved for this long
+VRP_WARM_START_TIMEOUT_S = 2  # Solver budget when seeded with the previous tick's routes
+VRP_NATIVE_TRANSITS = True  # Hand arc costs to OR-Tools as matrices instead of Python callbacks
+VRP_DECOMPOSE_ABOVE = 150  # Split the VRP into geographic clusters above this many emergencies
+VRP_CLUSTER_SIZE = 50  # Target emergencies per cluster when decomposing
+VRP_HORIZON_ABOVE = 60  # Large-instance mode above this many emergencies: droppable stops, greedy tail
+VRP_HORIZON_STOPS = 5  # Stops per vehicle the solver optimizes in large-instance mode
+VRP_PORTFOLIO_WORKERS = os.cpu_count()  # Processes racing different search strategies; 1 runs only the default one
+VALHALLA_WORKERS = os.cpu_count()  # Parallel Valhalla actors for matrix tiles and routes
+MATRIX_TILE_SIZE = 50  # Sources/targets per matrix tile; 50x50 fits Valhalla's default pair limit
+LEG_CACHE_SIZE = 10000  # Emergency-to-emergency route legs kept between ticks
+CANDIDATE_K = None  # Nearest vehicles/emergencies routed per emergency (8 or more recommended); None computes every cell
+PLAN_ETA_TOLERANCE_S = 30  # Stored plan ETAs are only rewritten when they move by more than this
+PLAN_COPY_ABOVE = 500  # Insert new plans with PostgreSQL COPY instead of INSERTs above this many
+INCREMENTAL_FETCH = True  # Re-read only emergencies and vehicles reported changed by LISTEN/NOTIFY (PostgreSQL)
+DB_POOL_SIZE = 3  # Pooled connections per DataManager; each tick borrows short-lived ones
+DB_POOL_OVERFLOW = 2  # Extra connections allowed when the pool is exhausted
 VALHALLA_CONFIG_PATH = f"{volume_path}/tiles/valhalla.json"
 DB_URL = dbutils.widgets.get("DB_URL")
 
 # COMMAND ----------
 
-def run_simulation_tick(data_manager, routing_service):
+def run_simulation_tick(data_manager, routing_service, route_memory, motion_engine=None):
     """
-    Executes a single iteration of the simulation.
+    Executes a single iteration of the simulation. With a motion engine, vehicles are
+    moved by the engine and the tick only replans and removes reached emergencies.
     """
     print("\n--- Starting new simulation tick ---")
     
     # 1. Fetch current state from the database
     emergencies, vehicles = data_manager.get_entities()
+    reached_ids = motion_engine.completed() if motion_engine else set()
+    if reached_ids:
+        emergencies = [e for e in emergencies if e.id not in reached_ids]
     if not emergencies:
         print("No emergencies to plan for. Skipping tick.")
+        if reached_ids:
+            data_manager.update_state_in_transaction([], sorted(reached_ids), [])
+            motion_engine.forget_completed(reached_ids)
         return
     if not vehicles:
         print("No vehicles available. Skipping tick.")
         return
 
     # 2. Get the routing matrix from Valhalla
-    matrix_result = routing_service.get_matrix(emergencies, vehicles)
+    matrix = routing_service.get_matrix(emergencies, vehicles)
 
     # 3. Solve the Vehicle Routing Problem
-    optimizer = RouteOptimizer(matrix_result, len(vehicles), OPTIMIZATION_GOAL)
-    solution = optimizer.solve(VRP_TIMEOUT_S)
+    max_stops = VRP_HORIZON_STOPS if len(emergencies) > VRP_HORIZON_ABOVE else None
+    incumbent = Incumbent()  # Reports how soon the search had a plan, for tuning VRP_STALL_S and the timeouts
+    if DISPATCH_MODE == "assignment":
+        solution = AssignmentDispatcher(matrix, len(vehicles), OPTIMIZATION_GOAL).solve()
+    elif len(emergencies) > VRP_DECOMPOSE_ABOVE:
+        optimizer = DecomposedOptimizer(
+            matrix, len(vehicles), OPTIMIZATION_GOAL,
+            cluster_size=VRP_CLUSTER_SIZE, native_transits=VRP_NATIVE_TRANSITS, route_memory=route_memory,
+            max_stops=max_stops
+        )
+        solution = optimizer.solve(
+            VRP_TIMEOUT_S, warm_time_limit_seconds=VRP_WARM_START_TIMEOUT_S, stall_seconds=VRP_STALL_S,
+            on_improvement=incumbent
+        )
+    elif VRP_PORTFOLIO_WORKERS > 1:
+        optimizer = PortfolioOptimizer(
+            matrix, len(vehicles), OPTIMIZATION_GOAL, max_workers=VRP_PORTFOLIO_WORKERS,
+            native_transits=VRP_NATIVE_TRANSITS, route_memory=route_memory, max_stops=max_stops
+        )
+        solution = optimizer.solve(
+            VRP_TIMEOUT_S, warm_time_limit_seconds=VRP_WARM_START_TIMEOUT_S, stall_seconds=VRP_STALL_S,
+            on_improvement=incumbent
+        )
+    else:
+        optimizer = RouteOptimizer(
+            matrix, len(vehicles), OPTIMIZATION_GOAL,
+            native_transits=VRP_NATIVE_TRANSITS, route_memory=route_memory, max_stops=max_stops
+        )
+        solution = optimizer.solve(
+            VRP_TIMEOUT_S, warm_time_limit_seconds=VRP_WARM_START_TIMEOUT_S, stall_seconds=VRP_STALL_S,
+            on_improvement=incumbent
+        )
+    if incumbent.improvements:
+        print(f"{incumbent.improvements} improving plans published; the first after "
+              f"{incumbent.first_found_after:.2f}s, the best with objective {incumbent.objective}.")
 
     if "error" in solution:
-        print(f"Optimization failed: {solution['error']}. Skipping this tick.")
-        return
+        print(f"Optimization failed: {solution['error']}. Falling back to assignment dispatch.")
+        solution = AssignmentDispatcher(matrix, len(vehicles), OPTIMIZATION_GOAL).solve()
+
+    # 4. Fetch route geometry for the assigned legs only
+    routing_service.fetch_route_shapes(matrix, solution)
 
-    # 4. Process the solution to generate plans and update vehicle states
-    processor = PlanProcessor()
+    # 5. Process the solution to generate plans and update vehicle states
+    processor = PlanProcessor(UTM_EPSG, PASS_THROUGH_RADIUS_M)
     plans_to_save, completed_ids, vehicle_updates = processor.process_solution(
-        solution, vehicles, emergencies, matrix_result, DISTANCE_PER_TICK_M
+        solution, vehicles, emergencies, matrix, 0 if motion_engine else DISTANCE_PER_TICK_M
     )
+    if motion_engine:
+        # The engine owns vehicle positions; only its reached emergencies are added
+        vehicle_updates = []
+        completed_ids = sorted(set(completed_ids) | reached_ids)
 
-    # 5. COMMIT CHANGES TO DATABASE
+    # 6. COMMIT CHANGES TO DATABASE
     data_manager.update_state_in_transaction(
         plans_to_save, completed_ids, vehicle_updates
     )
-        
+    routing_service.evict_emergencies(completed_ids)
+    if motion_engine:
+        motion_engine.forget_completed(reached_ids)
+
     print("--- Simulation tick completed successfully ---")
 
 # COMMAND ----------
 
-data_manager = DataManager(DB_URL)
-routing_service = RoutingService(VALHALLA_CONFIG_PATH)
+data_manager = DataManager(
+    DB_URL, PLAN_ETA_TOLERANCE_S, PLAN_COPY_ABOVE, INCREMENTAL_FETCH,
+    pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_OVERFLOW
+)
+route_memory = RouteMemory()
+routing_service = RoutingService(
+    VALHALLA_CONFIG_PATH,
+    num_workers=VALHALLA_WORKERS,
+    tile_size=MATRIX_TILE_SIZE,
+    candidate_selector=CandidateSelector(CANDIDATE_K, CANDIDATE_K) if CANDIDATE_K else None,
+    leg_cache_size=LEG_CACHE_SIZE
+)
+
+motion_engine = None
+if MOTION_INTERVAL_S:
+    motion_engine = MotionEngine(DataManager(DB_URL), UTM_EPSG, MOTION_TIME_SCALE)
+    motion_engine.start(MOTION_INTERVAL_S)
 
 try:
     while True:
-        run_simulation_tick(data_manager, routing_service)
+        run_simulation_tick(data_manager, routing_service, route_memory, motion_engine)
         print(f"\nSleeping for {TICK_INTERVAL_SECONDS} seconds...")
         time.sleep(TICK_INTERVAL_SECONDS)
 # except KeyboardInterrupt:
@@ -103,7 +196,10 @@ try:
 # except Exception as e:
 #     print(f"\nAn unexpected error occurred: {e}")
 finally:
+    if motion_engine:
+        motion_engine.stop()
     data_manager.close()
+    routing_service.close()
 
 # COMMAND ----------
 
@@ -0,0 +1,104 @@
+from typing import List, Dict, Tuple, Any
+
+import numpy as np
+
+
+# Sentinel costs for matrix cells that are unreachable or were pruned and never
+# requested from Valhalla. They exceed the Time/Distance dimension capacities in
+# RouteOptimizer, so the solver treats such an arc as infeasible.
+PRUNED_TIME_S = 10_000_000
+PRUNED_DISTANCE_KM = 100_000
+
+
+def valhalla_arrays(result: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Converts a Valhalla matrix response into float64 time and distance arrays.
+
+    Accepts both the concise response (verbose=false), whose sources_to_targets holds
+    "durations" and "distances" arrays, and the verbose list of lists of cell dicts.
+    Unreachable cells (null in the response) become NaN.
+    """
+    sources_to_targets = result["sources_to_targets"]
+    if isinstance(sources_to_targets, dict):
+        time = np.array(sources_to_targets["durations"], dtype=np.float64)
+        distance = np.array(sources_to_targets["distances"], dtype=np.float64)
+    else:
+        time = np.array([[cell.get("time") for cell in row] for row in sources_to_targets], dtype=np.float64)
+        distance = np.array([[cell.get("distance") for cell in row] for row in sources_to_targets], dtype=np.float64)
+    return time, distance
+
+
+class TravelMatrix:
+    """
+    Dense travel time/distance matrix for one tick, indexed like emergencies + vehicles.
+
+    Attributes:
+        time: int32 array of travel times in seconds.
+        distance: float32 array of travel distances in kilometers.
+        lats, lons: float64 arrays with the coordinates of every location.
+        urgency: Urgency level name of every location (vehicles are "medium").
+        entity_ids: Database ID of the emergency or vehicle at every location.
+        num_emergencies: Number of leading locations that are emergencies.
+        shapes: WGS84 LineString of every route leg keyed by (from_node, to_node),
+            filled lazily by RoutingService.fetch_route_shapes().
+        leg_wkbs: WKB geometry of the emergency-to-emergency legs, keyed like
+            shapes, either fetched this tick or taken from RoutingService's leg cache.
+    """
+
+    def __init__(
+        self,
+        time: np.ndarray,
+        distance: np.ndarray,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        urgency: List[str],
+        entity_ids: np.ndarray,
+        num_emergencies: int
+    ):
+        self.time = np.rint(np.nan_to_num(time, nan=PRUNED_TIME_S)).astype(np.int32)
+        self.distance = np.nan_to_num(distance, nan=PRUNED_DISTANCE_KM).astype(np.float32)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.urgency = list(urgency)
+        self.entity_ids = np.asarray(entity_ids, dtype=np.int64)
+        self.num_emergencies = num_emergencies
+        self.shapes: Dict[Tuple[int, int], Any] = {}
+        self.leg_wkbs: Dict[Tuple[int, int], bytes] = {}
+
+    @property
+    def size(self) -> int:
+        """Number of locations in the matrix."""
+        return len(self.lats)
+
+    @property
+    def num_vehicles(self) -> int:
+        return self.size - self.num_emergencies
+
+    def location(self, node: int) -> Dict[str, float]:
+        """Returns a Valhalla location for the given matrix index."""
+        return {"lat": float(self.lats[node]), "lon": float(self.lons[node]), "type": "break"}
+
+    def subset(self, nodes: List[int]) -> "TravelMatrix":
+        """
+        Returns the matrix restricted to the given locations, in the given order.
+        Emergencies must come before vehicles, as in the full matrix.
+        """
+        nodes = np.asarray(nodes, dtype=np.intp)
+        cells = np.ix_(nodes, nodes)
+        return TravelMatrix(
+            self.time[cells],
+            self.distance[cells],
+            self.lats[nodes],
+            self.lons[nodes],
+            [self.urgency[n] for n in nodes],
+            self.entity_ids[nodes],
+            int((nodes < self.num_emergencies).sum())
+        )
+
+    def padded(self, extra: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the time and distance arrays with `extra` zero-cost rows and columns
+        appended, e.g. for virtual end depots.
+        """
+        pad = ((0, extra), (0, extra))
+        return np.pad(self.time, pad), np.pad(self.distance, pad)
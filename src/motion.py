@@ -0,0 +1,144 @@
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+import numpy as np
+import shapely
+from data import DataManager
+from geometry import reproject, utm_epsg, WGS84_EPSG
+
+
+class MotionEngine:
+    """
+    Moves vehicles along the leg they are currently driving, by elapsed time, on a
+    schedule of its own that is independent of how long replanning takes.
+
+    Each vehicle drives its first Plan.route at the average speed Valhalla reported
+    for that leg, i.e. the route length over the time left until the plan's ETA. A
+    vehicle that reaches its emergency waits there; the emergency is reported through
+    completed() so the next replanning tick can remove it in its own transaction.
+    """
+
+    MIN_LEG_SECONDS = 1.0  # Guards against ETAs that are already due
+
+    def __init__(self, data_manager: DataManager, utm_epsg: Optional[int] = None, time_scale: float = 1.0):
+        """
+        Args:
+            data_manager: A DataManager used only by this engine, since sessions
+                must not be shared between threads.
+            utm_epsg: EPSG code of the metric CRS used to move vehicles. Defaults to
+                the WGS84 UTM zone at the centre of the routes.
+            time_scale: Simulated seconds per wall-clock second.
+        """
+        self.data_manager = data_manager
+        self.utm_epsg = utm_epsg
+        self.time_scale = time_scale
+        # Vehicle ID -> (plan key, route in the metric CRS, metres driven, speed in m/s, emergency ID)
+        self._tracks: Dict[int, Tuple[Tuple, Any, float, float, int]] = {}
+        self._utm_epsg_code: Optional[int] = None
+        self._last_step: Optional[float] = None
+        self._completed: Set[int] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def completed(self) -> Set[int]:
+        """IDs of emergencies that vehicles have reached and that are not yet removed."""
+        with self._lock:
+            return set(self._completed)
+
+    def forget_completed(self, emergency_ids: Set[int]):
+        """Drops emergencies that have been removed from the database."""
+        with self._lock:
+            self._completed -= emergency_ids
+
+    def _load_legs(self, now: datetime):
+        """Starts tracking vehicles whose current leg has changed since the last step."""
+        legs = self.data_manager.get_next_legs()
+        current = {leg.vehicle_id for leg in legs}
+        for vehicle_id in set(self._tracks) - current:
+            del self._tracks[vehicle_id]
+
+        changed = [leg for leg in legs if self._tracks.get(leg.vehicle_id, (None,))[0] != (leg.emergency_id, leg.eta)]
+        if not changed:
+            return
+        routes = shapely.from_wkb([leg.route for leg in changed])
+        if self._utm_epsg_code is None:
+            centre = shapely.get_coordinates(routes).mean(axis=0)
+            self._utm_epsg_code = self.utm_epsg or utm_epsg([centre[0]], [centre[1]])
+
+        # Continue from where a vehicle is now rather than from where replanning saw it
+        previous = np.array([
+            shapely.line_interpolate_point(self._tracks[leg.vehicle_id][1], self._tracks[leg.vehicle_id][2])
+            if leg.vehicle_id in self._tracks else None
+            for leg in changed
+        ], dtype=object)
+        routes = reproject(routes, WGS84_EPSG, self._utm_epsg_code)
+        starts = np.where(shapely.is_missing(previous), 0.0, shapely.line_locate_point(routes, previous))
+        lengths = shapely.length(routes)
+        for leg, route, start, length in zip(changed, routes, starts, lengths):
+            seconds = max((leg.eta - now).total_seconds(), self.MIN_LEG_SECONDS)
+            # The ETA covers only what is left of the leg, so pace the remaining distance to it
+            speed = max(length - start, 0.0) / seconds
+            self._tracks[leg.vehicle_id] = ((leg.emergency_id, leg.eta), route, float(start), speed, leg.emergency_id)
+
+    def step(self) -> List[Dict[str, Any]]:
+        """
+        Advances every vehicle by the time elapsed since the previous step and writes
+        the new positions.
+
+        Returns:
+            The vehicle updates that were written, as dictionaries with vehicle ID,
+            new lon, and new lat.
+        """
+        now = time.monotonic()
+        elapsed = 0.0 if self._last_step is None else (now - self._last_step) * self.time_scale
+        self._last_step = now
+        self._load_legs(datetime.now())
+        if not self._tracks:
+            return []
+
+        vehicle_ids = list(self._tracks)
+        tracks = [self._tracks[vehicle_id] for vehicle_id in vehicle_ids]
+        routes = np.array([track[1] for track in tracks], dtype=object)
+        lengths = shapely.length(routes)
+        driven = np.minimum(np.array([track[2] + track[3] * elapsed for track in tracks]), lengths)
+        positions = reproject(shapely.line_interpolate_point(routes, driven), self._utm_epsg_code, WGS84_EPSG)
+
+        arrived = {track[4] for track, done in zip(tracks, driven >= lengths) if done}
+        for vehicle_id, track, distance in zip(vehicle_ids, tracks, driven):
+            self._tracks[vehicle_id] = track[:2] + (float(distance),) + track[3:]
+        if arrived:
+            with self._lock:
+                self._completed |= arrived
+
+        vehicle_updates = [
+            {"id": vehicle_id, "lon": float(lon), "lat": float(lat)}
+            for vehicle_id, lon, lat in zip(vehicle_ids, shapely.get_x(positions), shapely.get_y(positions))
+        ]
+        self.data_manager.update_vehicle_positions(vehicle_updates)
+        return vehicle_updates
+
+    def start(self, interval_seconds: float):
+        """Runs step() every interval_seconds on a background thread until stop()."""
+        def run():
+            while not self._stop.is_set():
+                started = time.monotonic()
+                try:
+                    self.step()
+                except Exception as e:
+                    print(f"ERROR: Motion step failed: {e}")
+                self._stop.wait(max(0.0, interval_seconds - (time.monotonic() - started)))
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name="motion-engine", daemon=True)
+        self._thread.start()
+        print(f"Motion engine moving vehicles every {interval_seconds}s.")
+
+    def stop(self):
+        """Stops the background thread and closes the engine's DataManager."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.data_manager.close()
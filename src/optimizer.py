@@ -1,117 +1,313 @@
-from typing import Dict, Any, List
+import threading
+import time
+from typing import Dict, Any, List, Optional, Callable
 from datetime import datetime, timedelta
+import numpy as np
 from ortools.constraint_solver import routing_enums_pb2, pywrapcp
+from matrix import TravelMatrix, PRUNED_TIME_S
+
+def route_etas(time_matrix, route_nodes: List[int]) -> List[datetime]:
+    """
+    Calculates the ETA at every stop after the first one in a route, using the
+    travel times from the matrix.
+    """
+    route_time = 0
+    etas = []
+    now = datetime.now()
+    # Start from the first segment to calculate ETA for the second stop onwards
+    for from_node, to_node in zip(route_nodes, route_nodes[1:]):
+        route_time += int(time_matrix[from_node, to_node])
+        etas.append(now + timedelta(seconds=route_time))
+    return etas
+
+
+class RouteMemory:
+    """
+    Remembers the most recent solution by vehicle and emergency ID, so that the next
+    tick's RouteOptimizer can be seeded with it even though node indices change.
+    """
+
+    def __init__(self):
+        self.routes: Dict[int, List[int]] = {}  # vehicle ID -> emergency IDs in visit order
+
+    def remember(self, matrix: TravelMatrix, solution: List[Dict[str, Any]]):
+        """Stores a formatted solution, translating node indices into entity IDs."""
+        self.routes = {
+            int(matrix.entity_ids[route["stops"][0]]): [int(matrix.entity_ids[node]) for node in route["stops"][1:]]
+            for route in solution
+        }
+
+
+class SolutionMonitor:
+    """
+    Called by OR-Tools on every solution found during the search. Publishes each
+    improved incumbent and finishes the search once the objective has not improved
+    for a given number of seconds.
+    """
+
+    def __init__(self, routing, format_routes: Callable[[], List[Dict[str, Any]]],
+                 stall_seconds: Optional[float] = None,
+                 on_improvement: Optional[Callable[[List[Dict[str, Any]], int], None]] = None):
+        self.routing = routing
+        self.format_routes = format_routes
+        self.stall_seconds = stall_seconds
+        self.on_improvement = on_improvement
+        self.best_objective = None
+        self.last_improvement = time.monotonic()
+
+    def __call__(self):
+        objective = self.routing.CostVar().Value()
+        now = time.monotonic()
+        if self.best_objective is None or objective < self.best_objective:
+            self.best_objective = objective
+            self.last_improvement = now
+            if self.on_improvement:
+                self.on_improvement(self.format_routes(), objective)
+        elif self.stall_seconds is not None and now - self.last_improvement > self.stall_seconds:
+            print(f"Objective stalled at {self.best_objective} for {self.stall_seconds}s; stopping search early.")
+            self.routing.solver().FinishCurrentSearch()
+
+
+class Incumbent:
+    """
+    An on_improvement callback that keeps the best solution published so far and
+    when the first one arrived. It is thread-safe, since the wrappers relay worker
+    incumbents from a background thread.
+    """
+
+    def __init__(self):
+        self.routes: Optional[List[Dict[str, Any]]] = None
+        self.objective: Optional[int] = None
+        self.improvements = 0
+        self.first_found_after: Optional[float] = None
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, routes: List[Dict[str, Any]], objective: int):
+        with self._lock:
+            if self.objective is not None and objective >= self.objective:
+                return
+            self.routes, self.objective = routes, objective
+            self.improvements += 1
+            if self.first_found_after is None:
+                self.first_found_after = time.monotonic() - self._started
+
 
 class RouteOptimizer:
     """Vehicle routing optimizer using OR-Tools."""
     
-    def __init__(self, data: Dict[str, Any], num_vehicles, goal):
+    POSITION_CAPACITY = 30
+    ROUTE_CAPACITY = 10000  # Maximum Time (s) or Distance (cost units) of one route
+    # Soft upper bound on the position of a stop and the penalty per position over it:
+    # high urgency should be a first stop, medium urgency a first or second stop.
+    URGENCY_SOFT_BOUNDS = {"high": (1, 50000), "medium": (2, 10000)}
+    # Low urgency increments position counter faster
+    URGENCY_POSITION_WEIGHTS = {"high": 1, "medium": 2, "low": 3}
+    # Price of leaving an emergency out of the plan in large-instance mode; well above
+    # the soft bound penalties, so the solver drops low urgency stops first.
+    URGENCY_DROP_PENALTIES = {"high": 1000000, "medium": 200000, "low": 50000}
+
+    def __init__(self, matrix: TravelMatrix, num_vehicles, goal, native_transits=False,
+                 route_memory: Optional[RouteMemory] = None, max_stops: Optional[int] = None):
         """
         Initialize the optimizer with input data.
         
         Args:
-            data: Dictionary containing sources_to_targets, sources, targets, etc.
+            matrix: The TravelMatrix from RoutingService, indexed like emergencies + vehicles.
             num_vehicles: The number of vehicles to use.
             goal: The optimization objective, e.g., "time" or "distance".
+            native_transits: Register arc costs and position weights as precomputed
+                integer data instead of Python callbacks, so OR-Tools evaluates arcs
+                without calling back into Python during the search.
+            route_memory: If given, the search starts from the remembered routes and
+                the new solution is stored back into it.
+            max_stops: Enables large-instance mode: each vehicle's route is optimized
+                for its next max_stops stops only, emergencies may be dropped at an
+                urgency-scaled penalty instead of making the model infeasible, and
+                dropped emergencies are then appended to routes greedily.
+
+        Pruned or unreachable arcs (PRUNED_* sentinel costs, e.g. from a candidate
+        selector) exceed the route capacity and are hard infeasibilities, so if the
+        matrix has any, emergencies become droppable as in large-instance mode and the
+        model stays solvable however few candidates were computed.
         """
-        self.data = data
-        self.distance_matrix = []
-        self.time_matrix = []
+        self.matrix = matrix
         self.goal = goal
-        self.num_locations = len(data['sources'])
+        self.native_transits = native_transits
+        self.route_memory = route_memory
+        self.max_stops = max_stops
+        self.droppable = max_stops is not None or bool(
+            (matrix.time[:, :matrix.num_emergencies] >= PRUNED_TIME_S).any()
+        )
+        self.num_locations = matrix.size
         self.num_vehicles = num_vehicles
         
-        self.urgency_levels = {i: source.get('urgency', 'medium') 
-                               for i, source in enumerate(data['targets'])}
+        self.urgency_levels = dict(enumerate(matrix.urgency))
         
         self.vehicle_starts = list(range(self.num_locations - self.num_vehicles, self.num_locations))
         self.vehicle_ends = []  # Will be set in _parse_matrices
         self.matrix_size = 0    # Will be set in _parse_matrices
+        self.objective = None   # Will be set by solve
         
         self._parse_matrices()
     
     def _parse_matrices(self):
-        """Parse the sources_to_targets data into distance and time matrices."""
-        # Add virtual end depots to allow vehicles to end anywhere
+        """Pads the travel matrix with virtual end depots and prepares solver costs."""
+        # Add virtual end depots to allow vehicles to end anywhere; arcs into them are free
         self.matrix_size = self.num_locations + self.num_vehicles
-        
-        self.distance_matrix = [[0] * self.matrix_size for _ in range(self.matrix_size)]
-        self.time_matrix = [[0] * self.matrix_size for _ in range(self.matrix_size)]
-        
-        sources_to_targets = self.data['sources_to_targets']
-        for source_routes in sources_to_targets:
-            for route in source_routes:
-                from_idx = route['from_index']
-                to_idx = route['to_index']
-                self.distance_matrix[from_idx][to_idx] = route.get('distance', 0)
-                self.time_matrix[from_idx][to_idx] = route.get('time', 0)
-        
-        virtual_end_depots = list(range(self.num_locations, self.matrix_size))
-        for i in range(self.num_locations):
-            for virtual_depot in virtual_end_depots:
-                self.distance_matrix[i][virtual_depot] = 0
-                self.time_matrix[i][virtual_depot] = 0
+        self.time_matrix, self.distance_matrix = self.matrix.padded(self.num_vehicles)
+        # Arc costs of the goal: seconds, or distance in units of 10 m
+        if self.goal == "time":
+            self.cost_matrix = self.time_matrix
+        else:
+            self.cost_matrix = (self.distance_matrix.astype(np.float64) * 100).astype(np.int64)
 
-        self.vehicle_ends = virtual_end_depots
+        self.vehicle_ends = list(range(self.num_locations, self.matrix_size))
         print(f"Matrix size set to: {self.matrix_size}x{self.matrix_size}")
         print(f"Vehicle starts: {self.vehicle_starts}, Vehicle ends: {self.vehicle_ends}")
 
     def _distance_callback(self, from_index: int, to_index: int) -> int:
         """Returns the distance between two nodes, scaled for the solver."""
-        return int(self.distance_matrix[from_index][to_index] * 100)
+        return int(float(self.distance_matrix[from_index, to_index]) * 100)
     
     def _time_callback(self, from_index: int, to_index: int) -> int:
         """Returns the travel time between two nodes."""
-        return int(self.time_matrix[from_index][to_index])
+        return int(self.time_matrix[from_index, to_index])
     
     def get_urgency_level(self, location_index: int) -> str:
         """Returns the urgency level for a given location index."""
         return self.urgency_levels.get(location_index, 'medium')
-    
-    def solve(self, time_limit_seconds=10):
+
+    def _position_weight(self, node: int) -> int:
+        """Position increment for arriving at a node; lower urgency counts as a later position."""
+        if node < self.num_locations:
+            return self.URGENCY_POSITION_WEIGHTS.get(self.get_urgency_level(node), 3)
+        return 1 # Default for virtual depots
+
+    def _arc_cost(self, from_node: int, to_node: int) -> int:
+        return int(self.cost_matrix[from_node, to_node])
+
+    def _warm_start_routes(self) -> List[List[int]]:
+        """
+        Maps the remembered routes onto this matrix's node indices.
+
+        Completed emergencies are dropped and emergencies the memory has not seen are
+        inserted at their cheapest position, so every emergency is visited once. When
+        stops are droppable, positions reached over pruned arcs are not used and an
+        emergency without any other position is left to the solver.
+
+        Returns:
+            For each vehicle, the emergency nodes it visits, excluding start and end.
+        """
+        node_of = {
+            int(entity_id): node for node, entity_id in enumerate(self.matrix.entity_ids[:self.matrix.num_emergencies])
+        }
+        routes, seen = [], set()
+        for start in self.vehicle_starts:
+            remembered = self.route_memory.routes.get(int(self.matrix.entity_ids[start]), [])
+            route = [node_of[e] for e in remembered if e in node_of and node_of[e] not in seen]
+            seen.update(route)
+            routes.append(route)
+        if self.max_stops is not None:
+            # Stops beyond the horizon are left to the solver, which may drop them.
+            routes = [route[:self.max_stops] for route in routes]
+            print(f"Warm start: {len(seen)} remembered stops, kept up to {self.max_stops} per vehicle.")
+            return routes
+
+        urgency_order = {"high": 0, "medium": 1}
+        new_nodes = sorted(
+            (node for node in node_of.values() if node not in seen),
+            key=lambda node: urgency_order.get(self.get_urgency_level(node), 2)
+        )
+        inserted = 0
+        for node in new_nodes:
+            best = None
+            for v, route in enumerate(routes):
+                path = [self.vehicle_starts[v]] + route + [self.vehicle_ends[v]]
+                for pos in range(1, len(path)):
+                    if self.droppable and max(self.time_matrix[path[pos - 1], node],
+                                              self.time_matrix[node, path[pos]]) >= PRUNED_TIME_S:
+                        continue
+                    delta = (self._arc_cost(path[pos - 1], node) + self._arc_cost(node, path[pos])
+                             - self._arc_cost(path[pos - 1], path[pos]))
+                    if best is None or delta < best[0]:
+                        best = (delta, v, pos - 1)
+            if best is None:
+                continue
+            _, v, pos = best
+            routes[v].insert(pos, node)
+            inserted += 1
+        print(f"Warm start: {len(seen)} remembered stops kept, {inserted} of {len(new_nodes)} new stops inserted.")
+        return routes
+
+    def solve(self, time_limit_seconds=10, warm_time_limit_seconds=None, stall_seconds=None, on_improvement=None,
+              first_solution_strategy="PATH_CHEAPEST_ARC", local_search_metaheuristic="GUIDED_LOCAL_SEARCH"):
         """
         Solve the Vehicle Routing Problem.
         
         Args:
             time_limit_seconds: The maximum time to let the solver run.
+            warm_time_limit_seconds: A shorter limit used when the search can be
+                warm-started from the route memory.
+            stall_seconds: Stop the search once the best objective has not improved
+                for this many seconds, instead of always running to the time limit.
+            on_improvement: Called as on_improvement(routes, objective) with every
+                improved incumbent, in the same format solve() returns.
+            first_solution_strategy: Name of an OR-Tools FirstSolutionStrategy.
+            local_search_metaheuristic: Name of an OR-Tools LocalSearchMetaheuristic.
 
         Returns:
-            A list of vehicle route dictionaries or an error dictionary.
+            A list of vehicle route dictionaries or an error dictionary. The objective
+            value of the solution is left in self.objective.
         """
+        self.objective = None
         manager = pywrapcp.RoutingIndexManager(
             self.matrix_size, self.num_vehicles, self.vehicle_starts, self.vehicle_ends
         )
         routing = pywrapcp.RoutingModel(manager)
         
-        def transit_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            return self._time_callback(from_node, to_node) if self.goal == "time" else self._distance_callback(from_node, to_node)
+        # The only per-cell Python lists: the goal's costs, for OR-Tools or the callback, freed with the model
+        costs = self.cost_matrix.tolist()
+        if self.native_transits:
+            transit_callback_index = routing.RegisterTransitMatrix(costs)
+        else:
+            def transit_callback(from_index, to_index):
+                return costs[manager.IndexToNode(from_index)][manager.IndexToNode(to_index)]
 
-        transit_callback_index = routing.RegisterTransitCallback(transit_callback)
+            transit_callback_index = routing.RegisterTransitCallback(transit_callback)
         routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
         # --- URGENCY PENALTY LOGIC REINSTATED ---
-        def weighted_position_callback(from_index, to_index):
-            """Penalizes visiting low-priority stops earlier in a route."""
-            to_node = manager.IndexToNode(to_index)
-            if to_node < self.num_locations:
-                urgency = self.get_urgency_level(to_node)
-                if urgency == "high": return 1
-                if urgency == "medium": return 2
-                return 3 # Low urgency increments position counter faster
-            return 1 # Default for virtual depots
-
-        position_callback_index = routing.RegisterTransitCallback(weighted_position_callback)
+        if self.native_transits:
+            # A unary transit is charged when leaving a node rather than when entering it.
+            # With vehicle starts weighted 0, the cumul at a node is the entering-weight
+            # cumul minus that node's own weight, so capacity and bounds shift to match.
+            position_weights = [self._position_weight(node) for node in range(self.num_locations)]
+            for start in self.vehicle_starts:
+                position_weights[start] = 0
+            position_weights += [0] * self.num_vehicles
+            position_callback_index = routing.RegisterUnaryTransitVector(position_weights)
+            position_offset = self._position_weight
+            position_capacity = self.POSITION_CAPACITY - self._position_weight(self.vehicle_ends[0])
+        else:
+            def weighted_position_callback(from_index, to_index):
+                """Penalizes visiting low-priority stops earlier in a route."""
+                return self._position_weight(manager.IndexToNode(to_index))
 
+            position_callback_index = routing.RegisterTransitCallback(weighted_position_callback)
+            position_offset = lambda node: 0
+            position_capacity = self.POSITION_CAPACITY
+
+        # Pruned arcs carry sentinel costs far above this capacity, which makes them infeasible;
+        # matrices with such arcs make every emergency droppable instead (see __init__).
         dimension_name = 'Time' if self.goal == "time" else 'Distance'
         routing.AddDimension(
-            transit_callback_index, 0, 10000, True, dimension_name
+            transit_callback_index, 0, self.ROUTE_CAPACITY, True, dimension_name
         )
 
         position_dimension_name = 'Position'
         routing.AddDimension(
-            position_callback_index, 0, 30, True, position_dimension_name
+            position_callback_index, 0, position_capacity, True, position_dimension_name
         )
         position_dimension = routing.GetDimensionOrDie(position_dimension_name)
 
@@ -120,36 +316,112 @@ class RouteOptimizer:
                 continue
             index = manager.NodeToIndex(loc_id)
             urgency = self.get_urgency_level(loc_id)
-            if urgency == "high":
-                # High penalty if not visited in position 1 (first stop)
-                position_dimension.SetCumulVarSoftUpperBound(index, 1, 50000)
-            elif urgency == "medium":
-                # Medium penalty if not visited by position 2
-                position_dimension.SetCumulVarSoftUpperBound(index, 2, 10000)
+            if urgency in self.URGENCY_SOFT_BOUNDS:
+                bound, penalty = self.URGENCY_SOFT_BOUNDS[urgency]
+                position_dimension.SetCumulVarSoftUpperBound(index, bound - position_offset(loc_id), penalty)
         # --- END OF URGENCY LOGIC ---
 
+        if self.droppable:
+            for node in range(self.matrix.num_emergencies):
+                penalty = self.URGENCY_DROP_PENALTIES.get(self.get_urgency_level(node), self.URGENCY_DROP_PENALTIES["low"])
+                routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
+        if self.max_stops is not None:
+            stop_counts = [1] * self.matrix.num_emergencies + [0] * (self.matrix_size - self.matrix.num_emergencies)
+            stops_callback_index = routing.RegisterUnaryTransitVector(stop_counts)
+            routing.AddDimension(stops_callback_index, 0, self.max_stops, True, 'Stops')
+
         search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-        search_parameters.first_solution_strategy = (
-            routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
-        search_parameters.local_search_metaheuristic = (
-            routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
+        search_parameters.first_solution_strategy = getattr(
+            routing_enums_pb2.FirstSolutionStrategy, first_solution_strategy)
+        search_parameters.local_search_metaheuristic = getattr(
+            routing_enums_pb2.LocalSearchMetaheuristic, local_search_metaheuristic)
         search_parameters.time_limit.FromSeconds(time_limit_seconds)
         # search_parameters.log_search = True
         
-        print(f"Solving VRP (time limit: {time_limit_seconds}s)...")
-        solution = routing.SolveWithParameters(search_parameters)
+        if stall_seconds is not None or on_improvement is not None:
+            monitor = SolutionMonitor(
+                routing,
+                lambda: self._format_routes(manager, routing, lambda var: var.Value()),
+                stall_seconds,
+                on_improvement
+            )
+            routing.AddAtSolutionCallback(monitor)
+
+        initial_solution = None
+        if self.route_memory and self.route_memory.routes:
+            routing.CloseModelWithParameters(search_parameters)
+            initial_routes = [[manager.NodeToIndex(node) for node in route] for route in self._warm_start_routes()]
+            initial_solution = routing.ReadAssignmentFromRoutes(initial_routes, True)
+            if not initial_solution:
+                print("Remembered routes are not feasible for this model; solving from scratch.")
+
+        if initial_solution:
+            if warm_time_limit_seconds is not None:
+                search_parameters.time_limit.FromSeconds(warm_time_limit_seconds)
+            print(f"Solving VRP from previous routes (time limit: {search_parameters.time_limit.seconds}s)...")
+            solution = routing.SolveFromAssignmentWithParameters(initial_solution, search_parameters)
+        else:
+            print(f"Solving VRP (time limit: {time_limit_seconds}s)...")
+            solution = routing.SolveWithParameters(search_parameters)
         
         if solution:
-            print("Solver found a solution.")
-            return self._format_solution(manager, routing, solution)
+            self.objective = solution.ObjectiveValue()
+            print(f"Solver found a solution (objective: {self.objective}).")
+            vehicle_routes = self._format_solution(manager, routing, solution)
+            if self.droppable:
+                self._append_leftovers(vehicle_routes)
+            if self.route_memory is not None:
+                self.route_memory.remember(self.matrix, vehicle_routes)
+            return vehicle_routes
         else:
             status_map = {0: "NOT_SOLVED", 1: "SUCCESS", 2: "FAIL", 3: "FAIL_TIMEOUT", 4: "INVALID"}
             error_msg = f"No solution found. Status: {status_map.get(routing.status(), 'UNKNOWN')}"
             print(error_msg)
             return {"error": error_msg}
     
+    def _append_leftovers(self, vehicle_routes: List[Dict[str, Any]]):
+        """
+        Appends the emergencies the solver dropped to the end of routes, most urgent
+        first, each to the vehicle whose last stop is cheapest to continue from.
+        Emergencies no vehicle can reach wait for the next tick.
+
+        Args:
+            vehicle_routes: Formatted routes, modified in place.
+        """
+        routed = {node for route in vehicle_routes for node in route["stops"]}
+        urgency_order = {"high": 0, "medium": 1}
+        leftovers = sorted(
+            (node for node in range(self.matrix.num_emergencies) if node not in routed),
+            key=lambda node: urgency_order.get(self.get_urgency_level(node), 2)
+        )
+        if not leftovers:
+            return
+        appended = 0
+        for node in leftovers:
+            best = None
+            for route in vehicle_routes:
+                last = route["stops"][-1]
+                if self.time_matrix[last, node] >= PRUNED_TIME_S:
+                    continue
+                cost = self._arc_cost(last, node)
+                if best is None or cost < best[0]:
+                    best = (cost, route)
+            if best:
+                best[1]["stops"].append(node)
+                appended += 1
+        for route in vehicle_routes:
+            route["etas"] = route_etas(self.time_matrix, route["stops"])
+        print(f"{len(leftovers)} emergencies left out of the optimized plan, {appended} appended greedily.")
+
     def _format_solution(self, manager, routing, solution) -> List[Dict[str, Any]]:
         """Formats the raw solver solution into a more usable structure."""
+        return self._format_routes(manager, routing, solution.Value)
+
+    def _format_routes(self, manager, routing, value_of) -> List[Dict[str, Any]]:
+        """
+        Formats routes given a function that reads a solver variable's value, which
+        works both for a final assignment and for the incumbent during the search.
+        """
         vehicle_routes = []
         for vehicle_id in range(self.num_vehicles):
             index = routing.Start(vehicle_id)
@@ -158,28 +430,12 @@ class RouteOptimizer:
                 node_index = manager.IndexToNode(index)
                 if node_index < self.num_locations: # Exclude virtual depots
                     route_nodes.append(node_index)
-                index = solution.Value(routing.NextVar(index))
+                index = value_of(routing.NextVar(index))
             
-            # --- ETA CALCULATION LOGIC CORRECTED ---
-            route_time = 0
-            route_distance = 0
-            etas = []
-            # Start from the first segment to calculate ETA for the second stop onwards
-            for i in range(len(route_nodes) - 1):
-                from_node = route_nodes[i]
-                to_node = route_nodes[i+1]
-                
-                # Use the original time and distance from our matrices
-                route_time += self.time_matrix[from_node][to_node]
-                route_distance += self.distance_matrix[from_node][to_node]
-                
-                # Append the ETA for the destination of this segment
-                etas.append(datetime.now() + timedelta(seconds=route_time))
-
             vehicle_routes.append({
                 "vehicle_id": vehicle_id, 
                 "stops": route_nodes,
-                "etas": etas
+                "etas": route_etas(self.time_matrix, route_nodes)
             })
         
         return vehicle_routes
@@ -1,13 +1,10 @@
-import json
-from io import StringIO
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional
 
-import geopandas as gpd
-from shapely.geometry import LineString, Point
+import numpy as np
+import shapely
 from lakebase_responders_entities import Plan, Vehicle, Emergency
-
-
-UTM_CRS_EPSG = 25833
+from geometry import advance_along, travelled_lines, within_distance, points_near, reproject, utm_epsg, WGS84_EPSG
+from matrix import TravelMatrix
 
 
 class PlanProcessor:
@@ -16,48 +13,24 @@ class PlanProcessor:
     and calculate vehicle state updates for the next simulation tick.
     """
 
-    def _remove_first_point(self, geom: LineString) -> LineString:
-        """Removes the first coordinate from a LineString, effectively trimming the start."""
-        if isinstance(geom, LineString) and len(geom.coords) > 2:
-            return LineString(geom.coords[1:])
-        return geom
-
-    def _get_next_waypoint(self, geom: LineString, distance_resolution: int):
-        """Gets the second coordinate of a LineString, representing the next step."""
-        if isinstance(geom, LineString) and len(geom.coords) > 1:
-            current_location = gpd.GeoSeries([Point(geom.coords[0])], crs=f"EPSG:{UTM_CRS_EPSG}")
-            for c in geom.coords[1:]:
-                new_location = gpd.GeoSeries([Point(c)], crs=f"EPSG:{UTM_CRS_EPSG}")
-                if current_location.distance(new_location).iloc[0] > distance_resolution:
-                    return new_location
-
-            return new_location #Point(geom.coords[1])
-        # Return an empty point as a safe fallback
-        return gpd.GeoSeries([Point()], crs=f"EPSG:{UTM_CRS_EPSG}")
-
-    def _is_emergency_completed(self, vehicle_pos: Point, emergency: Emergency, threshold_meters=50) -> bool:
+    def __init__(self, utm_epsg: Optional[int] = None, pass_through_radius_m: float = 50):
         """
-        Checks if a vehicle is within a given distance of an emergency,
-        considering it "completed".
+        Args:
+            utm_epsg: EPSG code of the metric CRS used to move vehicles, e.g. 25833
+                for Berlin. Defaults to the WGS84 UTM zone at the centre of the tick's
+                emergencies.
+            pass_through_radius_m: An emergency is also completed when any vehicle's
+                path during the tick passes within this distance of it.
         """
-        # A suitable UTM zone for Berlin to get accurate meter-based distances
-         
-        if not isinstance(vehicle_pos, Point) or vehicle_pos.is_empty:
-            return False
-            
-        v_location = gpd.GeoSeries([vehicle_pos], crs=f"EPSG:{UTM_CRS_EPSG}")
-        e_location = gpd.GeoSeries([Point(emergency.lon, emergency.lat)], crs="EPSG:4326").to_crs(f"EPSG:{UTM_CRS_EPSG}")
-        
-        distance = v_location.distance(e_location).iloc[0]
-        
-        return distance < threshold_meters
+        self.utm_epsg = utm_epsg
+        self.pass_through_radius_m = pass_through_radius_m
 
     def process_solution(
         self, 
         solution: List[Dict[str, Any]], 
         vehicles: List[Vehicle], 
         emergencies: List[Emergency], 
-        matrix_result: Dict[str, Any],
+        matrix: TravelMatrix,
         distance_resolution: int
     ) -> Tuple[List[Plan], List[int], List[Dict[str, Any]]]:
         """
@@ -68,7 +41,10 @@ class PlanProcessor:
             solution: The list of routes from optimizer.solve().
             vehicles: The list of Vehicle objects from the database.
             emergencies: The list of Emergency objects from the database.
-            matrix_result: The raw matrix from Valhalla, used for route shapes.
+            matrix: The TravelMatrix from RoutingService, with the shapes of the
+                solution's legs added by RoutingService.fetch_route_shapes().
+            distance_resolution: Distance in meters each vehicle advances along its
+                route, which is also how close it must get to complete an emergency.
 
         Returns:
             A tuple containing (plans_to_save, completed_emergency_ids, vehicle_updates).
@@ -78,66 +54,73 @@ class PlanProcessor:
         vehicle_updates = []
         num_emergencies = len(emergencies)
 
+        routes = []
         for route_info in solution:
-            stops = route_info['stops']
-            
-            vehicle_start_node_idx = stops[0]
-            vehicle_list_idx = vehicle_start_node_idx - num_emergencies
-            
+            vehicle_list_idx = route_info['stops'][0] - num_emergencies
             if not (0 <= vehicle_list_idx < len(vehicles)):
                 print(f"Warning: Invalid vehicle index {vehicle_list_idx}. Skipping route.")
                 continue
-            
             vehicle = vehicles[vehicle_list_idx]
-            
-            if len(stops) > 1:
-                first_destination_idx = stops[1]
-                route_details = matrix_result["sources_to_targets"][vehicle_start_node_idx][first_destination_idx]
-                distance_to_next = route_details.get('distance', 0)
-                print(f"Vehicle ID {vehicle.id} assigned route. Next stop node {first_destination_idx}, distance: {distance_to_next:.2f} km.")
-
-                route_geojson = json.dumps(route_details["shape"])
-                route_gps = gpd.GeoSeries.from_file(StringIO(route_geojson), driver='GeoJSON')
-                route_gps.set_crs("EPSG:4326")
-                try:
-                    route_gps_segmented = route_gps.to_crs(UTM_CRS_EPSG).simplify(distance_resolution / 1000).segmentize(distance_resolution / 10)
-                except Exception:
-                    route_gps_segmented = route_gps.to_crs(UTM_CRS_EPSG)
-                
-
-                next_waypoint_gps = self._get_next_waypoint(route_gps_segmented.iloc[0], distance_resolution)
-                next_waypoint_WGS84 = next_waypoint_gps.to_crs("EPSG:4326").iloc[0]
-
-                if next_waypoint_WGS84 and not next_waypoint_WGS84.is_empty:
-                    vehicle_updates.append({
-                        "id": vehicle.id,
-                        "lon": next_waypoint_WGS84.x,
-                        "lat": next_waypoint_WGS84.y
-                    })
-                
-                updated_route_gps = route_gps_segmented.apply(self._remove_first_point)
-
-                for i in range(1, len(stops)):
-                    from_node_idx, to_node_idx = stops[i-1], stops[i]
-                    
-                    if to_node_idx >= num_emergencies: continue 
-
-                    emergency = emergencies[to_node_idx]
-                    eta = route_info['etas'][i-1]
-                    
-                    if i == 1 and self._is_emergency_completed(next_waypoint_gps.iloc[0], emergency, distance_resolution):
-                        if emergency.id not in completed_emergency_ids:
-                            completed_emergency_ids.append(emergency.id)
-                        continue
-                    
-                    route_wkb = (updated_route_gps.to_crs(f"EPSG:4326").to_wkb()[0] if i == 1 
-                                 else gpd.GeoSeries.from_file(StringIO(json.dumps(matrix_result["sources_to_targets"][from_node_idx][to_node_idx]["shape"])), driver='GeoJSON').to_wkb()[0])
-
-                    plans_to_save.append(Plan(
-                        vehicle_id=vehicle.id, plan_index=i,
-                        emergency_id=emergency.id, route=route_wkb, eta=eta
-                    ))
+            if len(route_info['stops']) > 1:
+                routes.append((route_info, vehicle))
             else:
                 print(f"Vehicle ID {vehicle.id} has no tasks. Position remains unchanged.")
-
-        return plans_to_save, completed_emergency_ids, vehicle_updates
\ No newline at end of file
+        if not routes:
+            return plans_to_save, completed_emergency_ids, vehicle_updates
+
+        # Every coordinate of the tick goes through one forward and one inverse projection
+        emergency_lons = [e.lon for e in emergencies]
+        emergency_lats = [e.lat for e in emergencies]
+        utm_epsg_code = self.utm_epsg or utm_epsg(emergency_lons, emergency_lats)
+        first_legs = np.array([matrix.shapes[tuple(route_info['stops'][:2])] for route_info, _ in routes], dtype=object)
+        projected = reproject(
+            np.concatenate((first_legs, shapely.points(emergency_lons, emergency_lats))), WGS84_EPSG, utm_epsg_code
+        )
+        emergency_points = projected[len(routes):]
+        first_legs = projected[:len(routes)]
+        next_waypoints, remaining_routes = advance_along(first_legs, distance_resolution)
+
+        # A vehicle completes its first stop once it is within one tick of it, and any
+        # emergency its path passes on the way
+        first_destinations = [route_info['stops'][1] for route_info, _ in routes]
+        arrived = within_distance(next_waypoints, emergency_points[first_destinations], distance_resolution)
+        passed = points_near(
+            travelled_lines(first_legs, next_waypoints, distance_resolution), emergency_points, self.pass_through_radius_m
+        )
+        completed_nodes = set(np.asarray(first_destinations)[arrived].tolist()) | set(passed.tolist())
+        completed_emergency_ids = sorted(emergencies[node].id for node in completed_nodes)
+
+        unprojected = reproject(np.concatenate((next_waypoints, remaining_routes)), utm_epsg_code, WGS84_EPSG)
+        next_waypoints_WGS84, remaining_routes_WGS84 = unprojected[:len(routes)], unprojected[len(routes):]
+
+        # Every remaining leg without WKB from the leg cache is encoded in one call,
+        # and the results are split back into plans
+        legs, route_wkbs, to_encode, leg_geometries = [], [], [], []
+        for r, (route_info, vehicle) in enumerate(routes):
+            stops = route_info['stops']
+            for i in range(1, len(stops)):
+                from_node_idx, to_node_idx = stops[i-1], stops[i]
+                if to_node_idx >= num_emergencies or to_node_idx in completed_nodes:
+                    continue
+                legs.append((vehicle.id, i, emergencies[to_node_idx].id, route_info['etas'][i-1]))
+                route_wkbs.append(matrix.leg_wkbs.get((from_node_idx, to_node_idx)) if i > 1 else None)
+                if route_wkbs[-1] is None:
+                    to_encode.append(len(legs) - 1)
+                    leg_geometries.append(remaining_routes_WGS84[r] if i == 1 else matrix.shapes[(from_node_idx, to_node_idx)])
+        for n, route_wkb in zip(to_encode, shapely.to_wkb(np.array(leg_geometries, dtype=object))):
+            route_wkbs[n] = route_wkb
+        plans_to_save = [
+            Plan(vehicle_id=vehicle_id, plan_index=plan_index, emergency_id=emergency_id, route=route_wkb, eta=eta)
+            for (vehicle_id, plan_index, emergency_id, eta), route_wkb in zip(legs, route_wkbs)
+        ]
+
+        lons, lats = shapely.get_x(next_waypoints_WGS84), shapely.get_y(next_waypoints_WGS84)
+        moved = ~np.isnan(lons)
+        vehicle_updates = [
+            {"id": vehicle.id, "lon": float(lon), "lat": float(lat)}
+            for (_, vehicle), lon, lat, ok in zip(routes, lons, lats, moved) if ok
+        ]
+        print(f"Advanced {int(moved.sum())} vehicles along their routes; "
+              f"{len(completed_emergency_ids)} emergencies completed, {len(plans_to_save)} plan legs remain.")
+
+        return plans_to_save, completed_emergency_ids, vehicle_updates
@@ -0,0 +1,180 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from matrix import TravelMatrix
+from optimizer import RouteOptimizer, RouteMemory
+
+
+_incumbents = None  # A worker's queue for (routes, objective), set by _set_incumbent_queue
+
+
+def _set_incumbent_queue(queue):
+    """Worker initializer that hands every worker the queue incumbents are published to."""
+    global _incumbents
+    _incumbents = queue
+
+
+def _solve_strategy(matrix: TravelMatrix, num_vehicles: int, goal: str, native_transits: bool,
+                    route_memory: Optional[RouteMemory], strategy: Tuple[str, str], time_limit_seconds: int,
+                    warm_time_limit_seconds: Optional[int], stall_seconds: Optional[float],
+                    max_stops: Optional[int]):
+    """Solves the full VRP with one search strategy. Runs in a worker process."""
+    first_solution_strategy, local_search_metaheuristic = strategy
+    optimizer = RouteOptimizer(matrix, num_vehicles, goal, native_transits=native_transits,
+                               route_memory=route_memory, max_stops=max_stops)
+    on_improvement = None
+    if _incumbents is not None:
+        on_improvement = lambda routes, objective: _incumbents.put((routes, objective))
+    result = optimizer.solve(
+        time_limit_seconds, warm_time_limit_seconds=warm_time_limit_seconds, stall_seconds=stall_seconds,
+        on_improvement=on_improvement,
+        first_solution_strategy=first_solution_strategy, local_search_metaheuristic=local_search_metaheuristic
+    )
+    return result, optimizer.objective
+
+
+class PortfolioOptimizer:
+    """
+    Runs the same VRP with several first-solution/metaheuristic combinations at once,
+    one per worker process and all under the same time limit, and keeps the solution
+    with the lowest objective.
+
+    A warm-started search ignores the first solution strategy, so once the route memory
+    holds routes only the first strategy of each metaheuristic starts from them; the
+    other strategies still solve from scratch, within the warm time limit.
+    """
+
+    # RouteOptimizer's default comes first; only the first max_workers entries run.
+    STRATEGIES = [
+        ("PATH_CHEAPEST_ARC", "GUIDED_LOCAL_SEARCH"),
+        ("PARALLEL_CHEAPEST_INSERTION", "GUIDED_LOCAL_SEARCH"),
+        ("SAVINGS", "SIMULATED_ANNEALING"),
+        ("PATH_CHEAPEST_ARC", "TABU_SEARCH"),
+        ("LOCAL_CHEAPEST_INSERTION", "GUIDED_LOCAL_SEARCH"),
+        ("GLOBAL_CHEAPEST_ARC", "SIMULATED_ANNEALING"),
+    ]
+
+    def __init__(self, matrix: TravelMatrix, num_vehicles, goal, strategies=None, max_workers=None,
+                 native_transits=True, route_memory: Optional[RouteMemory] = None, max_stops=None):
+        """
+        Args:
+            matrix: The TravelMatrix from RoutingService, indexed like emergencies + vehicles.
+            num_vehicles: The number of vehicles to use.
+            goal: The optimization objective, e.g., "time" or "distance".
+            strategies: (first solution strategy, metaheuristic) name pairs to try;
+                defaults to STRATEGIES.
+            max_workers: Maximum number of worker processes; defaults to the number of CPUs.
+            native_transits: Passed through to each strategy's RouteOptimizer.
+            route_memory: If given, one strategy per metaheuristic starts from the
+                remembered routes and the winning solution is stored back into it.
+            max_stops: Passed through to each strategy's RouteOptimizer.
+        """
+        self.matrix = matrix
+        self.num_vehicles = num_vehicles
+        self.goal = goal
+        self.strategies = strategies or self.STRATEGIES
+        self.max_workers = max_workers
+        self.native_transits = native_transits
+        self.route_memory = route_memory
+        self.max_stops = max_stops
+
+    @staticmethod
+    def _relay(queue, on_improvement: Callable[[List[Dict[str, Any]], int], None]):
+        """Passes on incumbents from all workers that beat the best one seen so far, until None."""
+        best = None
+        for routes, objective in iter(queue.get, None):
+            if best is None or objective < best:
+                best = objective
+                on_improvement(routes, objective)
+
+    def _runs(self, strategies: List[Tuple[str, str]], time_limit_seconds, warm_time_limit_seconds
+              ) -> List[Tuple[Optional[RouteMemory], int]]:
+        """
+        Decides the route memory and time limit of every strategy: without remembered
+        routes all of them solve from scratch; with them, the first strategy of each
+        metaheuristic is warm-started and the rest solve from scratch within the warm
+        time limit, so the portfolio still finishes in that time.
+        """
+        if self.route_memory is None or not self.route_memory.routes:
+            return [(self.route_memory, time_limit_seconds)] * len(strategies)
+        cold_time_limit = time_limit_seconds if warm_time_limit_seconds is None else warm_time_limit_seconds
+        runs, warm_metaheuristics = [], set()
+        for _, local_search_metaheuristic in strategies:
+            if local_search_metaheuristic in warm_metaheuristics:
+                runs.append((None, cold_time_limit))
+            else:
+                warm_metaheuristics.add(local_search_metaheuristic)
+                runs.append((self.route_memory, time_limit_seconds))
+        return runs
+
+    def solve(self, time_limit_seconds=10, warm_time_limit_seconds=None, stall_seconds=None, on_improvement=None):
+        """
+        Solve the Vehicle Routing Problem with every strategy in parallel.
+
+        Args:
+            time_limit_seconds: Wall-clock budget, shared by all strategies.
+            warm_time_limit_seconds: A shorter budget used when the search can be
+                warm-started from the route memory; strategies that solve from
+                scratch next to warm-started ones get it as well.
+            stall_seconds: Lets each strategy stop early once its objective stalls.
+            on_improvement: Called as on_improvement(routes, objective) whenever any
+                strategy finds a solution better than every one found so far. It runs
+                on a background thread of this process.
+
+        Returns:
+            A list of vehicle route dictionaries in RouteOptimizer.solve() format,
+            or an error dictionary if no strategy found a solution.
+        """
+        workers = min(self.max_workers or os.cpu_count(), len(self.strategies))
+        strategies = self.strategies[:workers]
+        runs = self._runs(strategies, time_limit_seconds, warm_time_limit_seconds)
+        warm = sum(route_memory is not None and bool(route_memory.routes) for route_memory, _ in runs)
+        print(f"Solving VRP with a portfolio of {len(strategies)} search strategies "
+              f"({warm} warm-started, {len(strategies) - warm} from scratch)...")
+
+        # Forking a parent that runs relay and driver threads can copy a held lock into the
+        # workers, so they are started from a clean forkserver process instead
+        context = multiprocessing.get_context("forkserver")
+        # A SimpleQueue put is synchronous, so every incumbent is queued before its worker returns
+        queue = context.SimpleQueue() if on_improvement else None
+        relay = None
+        if queue is not None:
+            relay = threading.Thread(target=self._relay, args=(queue, on_improvement), daemon=True)
+            relay.start()
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_set_incumbent_queue,
+                                     initargs=(queue,), mp_context=context) as pool:
+                futures = [
+                    pool.submit(_solve_strategy, self.matrix, self.num_vehicles, self.goal, self.native_transits,
+                                route_memory, strategy, time_limit, warm_time_limit_seconds,
+                                stall_seconds, self.max_stops)
+                    for strategy, (route_memory, time_limit) in zip(strategies, runs)
+                ]
+                results = [future.result() for future in futures]
+        finally:
+            if relay is not None:
+                queue.put(None)
+                relay.join()
+
+        best: Optional[Tuple[int, Tuple[str, str], List[Dict[str, Any]]]] = None
+        for strategy, (result, objective) in zip(strategies, results):
+            if "error" in result:
+                print(f"Strategy {'/'.join(strategy)} failed: {result['error']}")
+                continue
+            print(f"Strategy {'/'.join(strategy)} objective: {objective}")
+            if best is None or objective < best[0]:
+                best = (objective, strategy, result)
+
+        if best is None:
+            error_msg = "No solution found by any portfolio strategy."
+            print(error_msg)
+            return {"error": error_msg}
+
+        objective, strategy, vehicle_routes = best
+        print(f"Best portfolio strategy: {'/'.join(strategy)} (objective: {objective})")
+        if self.route_memory is not None:
+            self.route_memory.remember(self.matrix, vehicle_routes)
+        return vehicle_routes
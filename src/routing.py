@@ -1,61 +1,460 @@
 import json
-from typing import List, Dict, Any
+import threading
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple, Iterable, Optional, NamedTuple, Set
+import numpy as np
+import shapely
 import valhalla
 from lakebase_responders_entities import Emergency, Vehicle, UrgencyLevel
+from candidates import CandidateSelector
+from geometry import polylines_to_lines
+from matrix import TravelMatrix, valhalla_arrays, PRUNED_TIME_S, PRUNED_DISTANCE_KM
+
+
+class ValhallaActorPool:
+    """
+    A pool of Valhalla actors, one per worker thread, all loaded from the same config.
+
+    Valhalla actors are not thread-safe, but the Python bindings release the GIL while
+    a request is being served, so one actor per thread gives real parallelism. Large
+    matrix requests are split into source/target tiles that run concurrently and are
+    stitched back into a single result.
+    """
+
+    def __init__(self, config_path: str, num_workers: int = 1, tile_size: int = 50):
+        """
+        Args:
+            config_path: Path to the valhalla.json configuration file.
+            num_workers: Number of worker threads, each with its own actor.
+            tile_size: Maximum number of sources and of targets in one matrix tile.
+                Keep tile_size**2 within Valhalla's max_matrix_location_pairs limit.
+        """
+        self.config_path = config_path
+        self.num_workers = num_workers
+        self.tile_size = tile_size
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="valhalla")
+
+    def _actor(self) -> valhalla.Actor:
+        """Returns the calling worker thread's actor, loading it on first use."""
+        actor = getattr(self._local, "actor", None)
+        if actor is None:
+            actor = self._local.actor = valhalla.Actor(self.config_path)
+        return actor
+
+    def _call(self, action: str, *args) -> Dict[str, Any]:
+        return getattr(self._actor(), action)(*args)
+
+    def status(self) -> Dict[str, Any]:
+        return self._executor.submit(self._call, "status").result()
+
+    def route(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        return self._executor.submit(self._call, "route", query).result()
+
+    def map(self, action: str, queries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Runs independent requests of one kind concurrently, preserving their order."""
+        return list(self._executor.map(lambda q: self._call(action, q), queries))
+
+    def matrix(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Computes a matrix request, tiling it across the worker actors if it is large.
+
+        Returns:
+            A result in Valhalla's concise (verbose=false) matrix layout; stitched
+            results hold NumPy arrays rather than lists.
+        """
+        sources, targets = query["sources"], query["targets"]
+        tiles = [
+            (s0, t0, dict(query, sources=sources[s0:s0 + self.tile_size], targets=targets[t0:t0 + self.tile_size]))
+            for s0 in range(0, len(sources), self.tile_size)
+            for t0 in range(0, len(targets), self.tile_size)
+        ]
+        if len(tiles) == 1:
+            return self._executor.submit(self._call, "matrix", query).result()
+
+        results = self.map("matrix", [tile_query for _, _, tile_query in tiles])
+        durations = np.empty((len(sources), len(targets)))
+        distances = np.empty((len(sources), len(targets)))
+        for (s0, t0, _), tile_result in zip(tiles, results):
+            tile_time, tile_distance = valhalla_arrays(tile_result)
+            durations[s0:s0 + len(tile_time), t0:t0 + tile_time.shape[1]] = tile_time
+            distances[s0:s0 + len(tile_time), t0:t0 + tile_time.shape[1]] = tile_distance
+        return {
+            "sources": sources,
+            "targets": targets,
+            "sources_to_targets": {"durations": durations, "distances": distances}
+        }
+
+    def close(self):
+        """Shuts down the worker threads."""
+        self._executor.shutdown(wait=True)
+
+
+class Leg(NamedTuple):
+    """A cached route leg: WKB geometry, travel time in seconds and distance in kilometers."""
+    wkb: bytes
+    time: float
+    distance: float
+
+
+class LegCache:
+    """
+    LRU cache of route legs between two emergencies, keyed by (from emergency ID,
+    to emergency ID, costing). Emergencies do not move, so such a leg stays valid
+    until one of its ends is evicted. The geometry saves re-encoding plan routes,
+    and the time and distance save requesting the leg's matrix cell again.
+    """
+
+    def __init__(self, max_legs: int = 10000):
+        """
+        Args:
+            max_legs: Number of legs kept before the least recently used are dropped.
+        """
+        self.max_legs = max_legs
+        self._legs: "OrderedDict[Tuple[int, int, str], Leg]" = OrderedDict()
+        self._keys_of: Dict[int, Set[Tuple[int, int, str]]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._legs)
+
+    def get(self, from_id: int, to_id: int, costing: str) -> Optional[Leg]:
+        key = (from_id, to_id, costing)
+        leg = self._legs.get(key)
+        if leg is not None:
+            self._legs.move_to_end(key)
+        return leg
+
+    def put(self, from_id: int, to_id: int, costing: str, leg: Leg):
+        key = (from_id, to_id, costing)
+        self._legs[key] = leg
+        self._legs.move_to_end(key)
+        self._keys_of[from_id].add(key)
+        self._keys_of[to_id].add(key)
+        while len(self._legs) > self.max_legs:
+            self._unlink(self._legs.popitem(last=False)[0])
+
+    def evict(self, emergency_ids: Iterable[int]) -> int:
+        """Drops every leg that starts or ends at one of the given emergencies."""
+        stale = set()
+        for emergency_id in emergency_ids:
+            stale.update(self._keys_of.pop(emergency_id, ()))
+        for key in stale:
+            if self._legs.pop(key, None) is not None:
+                self._unlink(key)
+        return len(stale)
+
+    def retain(self, emergency_ids: Iterable[int]) -> int:
+        """Drops every leg that starts or ends at an emergency not among the given ones."""
+        keep = set(emergency_ids)
+        return self.evict([emergency_id for emergency_id in self._keys_of if emergency_id not in keep])
+
+    def _unlink(self, key: Tuple[int, int, str]):
+        for emergency_id in key[:2]:
+            keys = self._keys_of.get(emergency_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_of[emergency_id]
+
 
 class RoutingService:
     """Handles interactions with the Valhalla routing engine to get matrices."""
 
     COSTING = "auto"
     UNITS = "kilometers"
+    SNAP_DECIMALS = 5  # ~1 m at Berlin's latitude; smaller moves reuse cached cells
 
-    def __init__(self, config_path: str):
+    def __init__(
+        self,
+        config_path: str,
+        use_cache: bool = True,
+        skip_unused_pairs: bool = True,
+        num_workers: int = 1,
+        tile_size: int = 50,
+        candidate_selector: Optional[CandidateSelector] = None,
+        leg_cache_size: int = 10000
+    ):
         """
-        Initializes the Valhalla Actor.
+        Initializes the pool of Valhalla actors.
 
         Args:
             config_path: Path to the valhalla.json configuration file.
+            use_cache: Keep matrix cells between ticks and only recompute rows and
+                columns for entities that are new or have moved.
+            skip_unused_pairs: Only request cells whose target is an emergency. Arcs
+                into vehicle start locations are never used by the optimizer, so the
+                vehicle columns are filled with zeros instead of being computed.
+            num_workers: Number of Valhalla actors computing matrix tiles and routes in parallel.
+            tile_size: Maximum number of sources and of targets per matrix tile.
+            candidate_selector: If set, only the cells it selects are requested; the
+                other emergency columns are filled with the PRUNED_* sentinel costs.
+            leg_cache_size: Number of emergency-to-emergency route legs whose geometry,
+                time and distance are kept between ticks.
         """
-        print("Initializing Valhalla routing actor...")
-        self.actor = valhalla.Actor(config_path)
-        print(self.actor.status())
+        print(f"Initializing {num_workers} Valhalla routing actor(s)...")
+        self.actors = ValhallaActorPool(config_path, num_workers, tile_size)
+        print(self.actors.status())
+        self.use_cache = use_cache
+        self.skip_unused_pairs = skip_unused_pairs
+        self.candidate_selector = candidate_selector
+        # Cached cells live in square arrays indexed by slot; NaN marks a cell that has
+        # not been computed. Each cache key owns one row and one column.
+        self._slots: Dict[Tuple, int] = {}
+        self._free_slots: List[int] = []
+        self._time = np.full((0, 0), np.nan)
+        self._distance = np.full((0, 0), np.nan)
+        self.leg_cache = LegCache(leg_cache_size)
 
     def _make_locations(self, entities: List) -> List[dict]:
         """Creates the location format required by Valhalla."""
         return [{"lat": e.lat, "lon": e.lon, "type": "break"} for e in entities]
 
-    def get_matrix(self, emergencies: List[Emergency], vehicles: List[Vehicle]) -> Dict[str, Any]:
+    def _entity_key(self, kind: str, entity) -> Tuple:
+        """Cache key for an entity: its kind, ID and snapped location."""
+        return (kind, entity.id, round(entity.lat, self.SNAP_DECIMALS), round(entity.lon, self.SNAP_DECIMALS))
+
+    def _allocate(self, keys: List[Tuple]) -> np.ndarray:
+        """Returns the cache slot of every key, assigning free slots to new keys."""
+        for key in keys:
+            if key in self._slots:
+                continue
+            if not self._free_slots:
+                capacity = len(self._time)
+                grown = max(2 * capacity, 64)
+                for name in ("_time", "_distance"):
+                    array = np.full((grown, grown), np.nan)
+                    array[:capacity, :capacity] = getattr(self, name)
+                    setattr(self, name, array)
+                self._free_slots = list(range(grown - 1, capacity - 1, -1))
+            self._slots[key] = self._free_slots.pop()
+        return np.array([self._slots[key] for key in keys], dtype=np.intp)
+
+    def _evict(self, stale_keys: Iterable[Tuple]):
+        """Drops the rows and columns of the given keys from the cell cache."""
+        stale_keys = [key for key in set(stale_keys) if key in self._slots]
+        slots = [self._slots.pop(key) for key in stale_keys]
+        if not slots:
+            return
+        for array in (self._time, self._distance):
+            array[slots, :] = np.nan
+            array[:, slots] = np.nan
+        self._free_slots.extend(slots)
+
+    def evict_emergencies(self, emergency_ids: List[int]):
+        """
+        Removes completed emergencies from the matrix cache and the leg cache.
+
+        Args:
+            emergency_ids: IDs of emergencies that have been resolved.
+        """
+        completed = set(emergency_ids)
+        self.leg_cache.evict(completed)
+        self._evict([key for key in self._slots if key[0] == "emergency" and key[1] in completed])
+
+    def _fill_from_legs(self, emergencies: List[Emergency], slots: np.ndarray) -> int:
+        """
+        Fills unknown emergency -> emergency cells with the time and distance of
+        cached legs, and the unknown diagonal with zeros.
+
+        Returns:
+            The number of cells filled from the leg cache.
+        """
+        unknown = np.isnan(self._time[np.ix_(slots, slots)])
+        diagonal = np.flatnonzero(unknown.diagonal())
+        self._time[slots[diagonal], slots[diagonal]] = 0
+        self._distance[slots[diagonal], slots[diagonal]] = 0
+        if not len(self.leg_cache):
+            return 0
+        filled = 0
+        for i, j in zip(*np.nonzero(unknown)):
+            if i == j:
+                continue
+            leg = self.leg_cache.get(emergencies[i].id, emergencies[j].id, self.COSTING)
+            if leg is not None:
+                self._time[slots[i], slots[j]] = leg.time
+                self._distance[slots[i], slots[j]] = leg.distance
+                filled += 1
+        return filled
+
+    def _store(self, source_slots: np.ndarray, target_slots: np.ndarray, result: Dict[str, Any]):
+        """Writes a Valhalla matrix block into the cache; unreachable cells get sentinel costs."""
+        time, distance = valhalla_arrays(result)
+        cells = np.ix_(source_slots, target_slots)
+        self._time[cells] = np.nan_to_num(time, nan=PRUNED_TIME_S)
+        self._distance[cells] = np.nan_to_num(distance, nan=PRUNED_DISTANCE_KM)
+
+    def _matrix_query(self, sources: List[dict], targets: List[dict]) -> Dict[str, Any]:
+        return {
+            "sources": sources,
+            "targets": targets,
+            "costing": self.COSTING,
+            "directions_options": {"units": self.UNITS},
+            "verbose": False
+        }
+
+    def _request_cells(self, locations: List[dict], slots: np.ndarray, source_idx: List[int], target_idx: List[int]):
+        """Requests a sources x targets block from Valhalla and stores its cells in the cache."""
+        matrix_query = self._matrix_query([locations[i] for i in source_idx], [locations[j] for j in target_idx])
+        print(f"  - Requesting a {len(source_idx)}x{len(target_idx)} block from Valhalla...")
+        self._store(slots[source_idx], slots[target_idx], self.actors.matrix(matrix_query))
+
+    def _request_rows(self, locations: List[dict], slots: np.ndarray, targets_by_source: Dict[int, List[int]]):
+        """Requests one small one-to-many matrix per source, in parallel, and caches the cells."""
+        sources = list(targets_by_source)
+        matrix_queries = [
+            self._matrix_query([locations[i]], [locations[j] for j in targets_by_source[i]]) for i in sources
+        ]
+        print(f"  - Requesting {sum(len(t) for t in targets_by_source.values())} candidate cells "
+              f"in {len(sources)} rows from Valhalla...")
+        for i, row_result in zip(sources, self.actors.map("matrix", matrix_queries)):
+            self._store(slots[[i]], slots[targets_by_source[i]], row_result)
+
+    def get_matrix(self, emergencies: List[Emergency], vehicles: List[Vehicle]) -> TravelMatrix:
         """
-        Builds and executes a many-to-many matrix request to Valhalla.
+        Builds the many-to-many matrix for the current entities.
+
+        Cells between entities that have not moved since the previous call are
+        served from the cache; only rows and columns for new or moved entities
+        are requested from Valhalla. Emergency -> emergency cells that are not in the
+        cache are taken from the leg cache where possible, and rows and columns that
+        end up complete are not requested. With a candidate selector, only the
+        selected vehicle/emergency -> emergency cells are requested at all.
 
         Args:
             emergencies: A list of Emergency objects.
             vehicles: A list of Vehicle objects.
 
         Returns:
-            The matrix result from Valhalla.
+            A TravelMatrix indexed like emergencies + vehicles.
         """
         all_entities = emergencies + vehicles
         locations = self._make_locations(all_entities)
+        keys = ([self._entity_key("emergency", e) for e in emergencies]
+                + [self._entity_key("vehicle", v) for v in vehicles])
+
+        if not self.use_cache:
+            self._evict(list(self._slots))
+        current_keys = set(keys)
+        self._evict([key for key in self._slots if key not in current_keys])
+        # Legs of emergencies that are gone, independently of the cell cache
+        self.leg_cache.retain(e.id for e in emergencies)
+
+        new_idx = [i for i, key in enumerate(keys) if key not in self._slots]
+        cached_idx = [i for i, key in enumerate(keys) if key in self._slots]
+        slots = self._allocate(keys)
+        # Vehicles -> emergencies and emergencies -> emergencies are the only blocks
+        # the optimizer reads; everything else is only needed for a dense request.
+        num_targets = len(emergencies) if self.skip_unused_pairs else len(keys)
+        target_idx = list(range(num_targets))
+        new_target_idx = [j for j in new_idx if j < num_targets]
+        from_legs = self._fill_from_legs(emergencies, slots[:len(emergencies)])
+
+        print(f"\nBuilding a {len(locations)}x{len(locations)} matrix "
+              f"({len(new_idx)} new or moved locations, {from_legs} cells from cached legs)...")
+        if self.candidate_selector:
+            missing = defaultdict(list)
+            for j, source_idx in self.candidate_selector.select(emergencies, vehicles).items():
+                unknown = np.isnan(self._time[slots[source_idx], slots[j]])
+                for i in np.asarray(source_idx)[unknown]:
+                    missing[int(i)].append(j)
+            if missing:
+                self._request_rows(locations, slots, missing)
+        else:
+            if new_idx and target_idx:
+                unknown = np.isnan(self._time[np.ix_(slots[new_idx], slots[target_idx])]).any(axis=1)
+                source_idx = np.asarray(new_idx)[unknown].tolist()
+                if source_idx:
+                    self._request_cells(locations, slots, source_idx, target_idx)
+            if cached_idx and new_target_idx:
+                unknown = np.isnan(self._time[np.ix_(slots[cached_idx], slots[new_target_idx])]).any(axis=0)
+                new_target_idx = np.asarray(new_target_idx)[unknown].tolist()
+                if new_target_idx:
+                    self._request_cells(locations, slots, cached_idx, new_target_idx)
+
+        cells = np.ix_(slots, slots)
+        time, distance = self._time[cells], self._distance[cells]
+        time[:, num_targets:] = 0
+        distance[:, num_targets:] = 0
+        pruned = int(np.isnan(time).sum())
+        if pruned:
+            print(f"  - {pruned} pruned cells filled with sentinel costs.")
+        print("Matrix assembled successfully.")
+
+        # Vehicle locations get a default urgency level
+        urgency = [e.urgency.name for e in emergencies] + [UrgencyLevel.medium.name] * len(vehicles)
+        return TravelMatrix(
+            time,
+            distance,
+            lats=[loc["lat"] for loc in locations],
+            lons=[loc["lon"] for loc in locations],
+            urgency=urgency,
+            entity_ids=[e.id for e in all_entities],
+            num_emergencies=len(emergencies)
+        )
+
+    def fetch_route_shapes(self, matrix: TravelMatrix, solution: List[Dict[str, Any]]):
+        """
+        Fetches route geometry for the legs used by a solution.
+
+        The matrix itself carries no shapes, so geometry is requested lazily with one
+        multi-stop route request per vehicle; each leg of the returned trip is one
+        consecutive pair of stops. The requests run in parallel on the actor pool.
+        Shapes come back as compact polyline6 strings and are decoded straight into
+        shapely LineStrings.
+
+        Legs between two emergencies are looked up in the leg cache first: their WKB
+        goes into the matrix's `leg_wkbs` and a route is only requested up to its last
+        uncached leg. The first leg starts at the moving vehicle and is always fetched.
 
-        matrix_query = {
-            "sources": locations,
-            "targets": locations,
+        Args:
+            matrix: The result of get_matrix(). Leg shapes are stored in its `shapes`.
+            solution: The list of routes from optimizer.solve().
+        """
+        shapes, leg_wkbs = matrix.shapes, matrix.leg_wkbs
+        entity_ids = matrix.entity_ids
+        routes, cache_hits = [], 0
+        for route_info in solution:
+            stops = route_info["stops"]
+            if len(stops) < 2:
+                continue
+            last_uncached = 1
+            for k in range(2, len(stops)):
+                leg = self.leg_cache.get(int(entity_ids[stops[k - 1]]), int(entity_ids[stops[k]]), self.COSTING)
+                if leg is not None:
+                    leg_wkbs[(stops[k - 1], stops[k])] = leg.wkb
+                    cache_hits += 1
+                else:
+                    last_uncached = k
+            stops = stops[:last_uncached + 1]
+            if not all((a, b) in shapes for a, b in zip(stops, stops[1:])):
+                routes.append(stops)
+        route_queries = [{
+            "locations": [matrix.location(n) for n in stops],
             "costing": self.COSTING,
-            "directions_options": {"units": self.UNITS},
-            "shape_format": "geojson"
-        }
+            "directions_options": {"units": self.UNITS, "directions_type": "none"},
+            "shape_format": "polyline6"
+        } for stops in routes]
+
+        legs, encoded, summaries = [], [], []
+        for stops, route_result in zip(routes, self.actors.map("route", route_queries)):
+            for leg_nodes, leg in zip(zip(stops, stops[1:]), route_result["trip"]["legs"]):
+                legs.append(leg_nodes)
+                encoded.append(leg["shape"])
+                summaries.append(leg["summary"])
+        lines = polylines_to_lines(encoded)
+        shapes.update(zip(legs, lines))
+
+        # Only legs between two emergencies stay valid across ticks
+        cacheable = [n for n, (from_node, _) in enumerate(legs) if from_node < matrix.num_emergencies]
+        for n, wkb in zip(cacheable, shapely.to_wkb(lines[cacheable])):
+            from_node, to_node = legs[n]
+            leg_wkbs[legs[n]] = wkb
+            self.leg_cache.put(int(entity_ids[from_node]), int(entity_ids[to_node]), self.COSTING,
+                               Leg(wkb, summaries[n]["time"], summaries[n]["length"]))
+        print(f"Fetched route shapes for {len(legs)} legs; {cache_hits} legs found in the leg cache "
+              f"({len(self.leg_cache)} cached).")
 
-        print(f"\nRequesting a {len(locations)}x{len(locations)} matrix from Valhalla...")
-        matrix_result = self.actor.matrix(matrix_query)
-        print("Matrix received successfully.")
-
-        # Annotate the targets in the result with urgency levels
-        for target, entity in zip(matrix_result["targets"], all_entities):
-            if isinstance(entity, Emergency):
-                target["urgency"] = entity.urgency.name
-            else:
-                # Assign a default urgency for vehicle locations
-                target["urgency"] = UrgencyLevel.medium.name
-        
-        return matrix_result
\ No newline at end of file
+    def close(self):
+        """Shuts down the actor pool."""
+        self.actors.close()